@@ -508,7 +508,7 @@ define _binary-copy-to-final-strip
 $3: $2
 	@echo "Strip: $(call path-from-top,$2) => $(call path-from-top,$3)"
 	@mkdir -p $(dir $3)
-	$(Q) $($1_STRIP) -o $3 $2
+	$(Q) rm -f $3 && $($1_STRIP) -o $3 $2
 endef
 
 _binary-copy-to-staging = \
@@ -32,7 +32,7 @@ $(Q) cd $(PRIVATE_OBJ_DIR) && \
 		$(PRIVATE_LDLIBS) \
 		$(PRIVATE_ALL_SOURCES)
 @mkdir -p $(TARGET_OUT_STAGING)/$(TARGET_ROOT_DESTDIR)/share/gir-1.0
-$(Q) cp -af $@ $(TARGET_OUT_STAGING)/$(TARGET_ROOT_DESTDIR)/share/gir-1.0
+$(Q) cp -af --remove-destination $@ $(TARGET_OUT_STAGING)/$(TARGET_ROOT_DESTDIR)/share/gir-1.0
 endef
 
 define transform-gir-to-typelib
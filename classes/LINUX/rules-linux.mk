@@ -105,7 +105,7 @@ LINUX_EXPORTED_HEADERS_OVER := \
 linux-copy-image = \
 	$(if $(call streq,$(TARGET_LINUX_IMAGE),$1), \
 		if [ -f $(LINUX_BUILD_DIR)/arch/$(LINUX_SRCARCH)/boot/$1 ]; then \
-			cp -af $(LINUX_BUILD_DIR)/arch/$(LINUX_SRCARCH)/boot/$1 $(TARGET_OUT_STAGING)/boot; \
+			cp -af --remove-destination $(LINUX_BUILD_DIR)/arch/$(LINUX_SRCARCH)/boot/$1 $(TARGET_OUT_STAGING)/boot; \
 		fi; \
 	)
 
@@ -263,11 +263,11 @@ ifneq ("$(TARGET_LINUX_INSTALL_DEVICE_TREE)","0")
 	$(Q) $(MAKE) $(LINUX_MAKE_ARGS) dtbs_install
 else ifneq ("$(TARGET_LINUX_DEVICE_TREE_NAMES)","")
 	$(foreach __f,$(TARGET_LINUX_DEVICE_TREE_NAMES), \
-		$(Q) cp -af $(LINUX_BUILD_DIR)/arch/$(LINUX_SRCARCH)/boot/dts/$(__f) \
+		$(Q) cp -af --remove-destination $(LINUX_BUILD_DIR)/arch/$(LINUX_SRCARCH)/boot/dts/$(__f) \
 			$(TARGET_OUT_STAGING)/boot/$(endl) \
 	)
 endif
-	$(Q) cp -af $(LINUX_BUILD_DIR)/vmlinux $(TARGET_OUT_STAGING)/boot
+	$(Q) cp -af --remove-destination $(LINUX_BUILD_DIR)/vmlinux $(TARGET_OUT_STAGING)/boot
 	$(call linux-gen-sdk)
 	$(Q) cp -af $(LINUX_BUILD_DIR)/.config $(LINUX_BUILD_DIR)/linux.config
 	$(Q) echo "$(LINUX_ARCH)" > $(LINUX_BUILD_DIR)/linuxarch
@@ -40,7 +40,7 @@ $(LOCAL_BUILD_MODULE):
 		ARCH=$(PERF_ARCH) CROSS_COMPILE=$(TARGET_CROSS) DESTDIR=$(TARGET_OUT_STAGING) prefix=/$(TARGET_ROOT_DESTDIR) \
 		O=$(PRIVATE_BUILD_DIR) -C $(PRIVATE_PATH)/tools/perf
 	$(Q) mkdir -p $(TARGET_OUT_STAGING)/$(TARGET_DEFAULT_BIN_DESTDIR)
-	$(Q) cp -af $(PRIVATE_BUILD_DIR)/perf $(TARGET_OUT_STAGING)/$(TARGET_DEFAULT_BIN_DESTDIR)
+	$(Q) cp -af --remove-destination $(PRIVATE_BUILD_DIR)/perf $(TARGET_OUT_STAGING)/$(TARGET_DEFAULT_BIN_DESTDIR)
 	@touch $@
 
 # Clean rule
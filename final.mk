@@ -14,6 +14,26 @@ MAKEFINAL_SCRIPT := $(BUILD_SYSTEM)/scripts/makefinal.py
 LDCONFIG := $(BUILD_SYSTEM)/scripts/ldconfig.py
 GENPYC_SCRIPT := $(BUILD_SYSTEM)/scripts/genpyc.py
 
+# Information extracted from elf files, shared by scripts and across runs
+ELF_CACHE_FILE := $(TARGET_OUT)/elf-cache.json
+
+# Stripped files, shared by scripts and across runs
+STRIP_CACHE_DIR := $(TARGET_OUT)/strip-cache
+
+# State of library directories used by ldconfig to only rescan modified ones
+LDCONFIG_MANIFEST_FILE := $(TARGET_OUT)/ld.so.cache.manifest
+
+# State of the final tree used by makefinal to only copy modified files and
+# remove stale ones. Remove it to force a full generation.
+FINAL_MANIFEST_FILE := $(TARGET_OUT)/final.manifest
+
+# Files generated in the final tree after makefinal (pyc, ld.so.conf...), they
+# are removed by makefinal so they are generated again from up to date files
+FINAL_GENERATED_FILE := $(TARGET_OUT)/final.generated
+
+# Statistics (time per phase, files per action...) of the scripts
+FINAL_STATS_DIR := $(TARGET_OUT)/final-stats
+
 ifneq ("$(V)","0")
   MAKEFINAL_SCRIPT += -v
   LDCONFIG += -v
@@ -71,9 +91,23 @@ MAKEFINAL_ARGS += \
 MAKEFINAL_ARGS += \
 	--filelist=$(TARGET_OUT)/filelist.txt
 
+MAKEFINAL_ARGS += \
+	--elf-cache=$(ELF_CACHE_FILE) \
+	--strip-cache=$(STRIP_CACHE_DIR) \
+	--manifest=$(FINAL_MANIFEST_FILE) \
+	--generated=$(FINAL_GENERATED_FILE) \
+	--stats=$(FINAL_STATS_DIR)/makefinal.json
+
+# Python files removed once compiled are not installed again while up to date
+ifeq ("$(TARGET_FINAL_PYTHON_GENERATE_PYC)","1")
+  MAKEFINAL_ARGS += \
+	$(foreach __dir,$(TARGET_FINAL_PYTHON_REMOVE_PY),--removed-py="$(__dir)")
+endif
+
 # generation mode
 MAKEFINAL_ARGS += \
-	--mode=$(TARGET_FINAL_MODE)
+	--mode=$(TARGET_FINAL_MODE) \
+	--link-mode=$(TARGET_FINAL_LINK_MODE)
 
 # Construct contents of ld.so.preload
 _ld_so_preload_contents := $(strip $(foreach __mod,$(ALL_BUILD_MODULES), \
@@ -95,12 +129,14 @@ __final-internal:
 	@echo "Generating final tree..."
 ifneq ("$(TARGET_OS_FLAVOUR)","native-chroot")
 ifneq ("$(TARGET_OS_FLAVOUR)","native")
-	$(Q) rm -rf $(TARGET_OUT_FINAL)
+	$(Q) if [ ! -f $(FINAL_MANIFEST_FILE) -o ! -f $(FINAL_GENERATED_FILE) ]; then \
+		rm -rf $(TARGET_OUT_FINAL); \
+	fi
 endif
 endif
+	@mkdir -p $(FINAL_STATS_DIR)
 	$(Q) $(MAKEFINAL_SCRIPT) $(MAKEFINAL_ARGS) \
-		$(TARGET_OUT_STAGING) $(TARGET_OUT_FINAL) $(TARGET_OUT)/final.mk
-	$(Q) $(MAKE) -f $(TARGET_OUT)/final.mk
+		$(TARGET_OUT_STAGING) $(TARGET_OUT_FINAL)
 	@mkdir -p $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)
 ifeq ("$(TARGET_FINAL_PYTHON_GENERATE_PYC)","1")
 # Use compiled host version of python to generate pyc to make sure that at runtime
@@ -109,6 +145,8 @@ ifeq ("$(TARGET_FINAL_PYTHON_GENERATE_PYC)","1")
 		echo "Generating pyc files from python files"; \
 		$(HOST_OUT_STAGING)/usr/bin/python $(GENPYC_SCRIPT) \
 			--sysroot $(TARGET_OUT_FINAL) \
+			--stats $(FINAL_STATS_DIR)/genpyc.json \
+			--generated $(FINAL_GENERATED_FILE) \
 			$(TARGET_OUT_FINAL); \
 	fi
 ifneq ("$(TARGET_FINAL_PYTHON_REMOVE_PY)","")
@@ -124,19 +162,29 @@ endif
 ifeq ("$(TARGET_OS)","linux")
 ifeq ("$(is-full-system)","1")
 	@if [ ! -e $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/ld.so.conf ]; then \
+		echo "$(TARGET_DEFAULT_ETC_DESTDIR)/ld.so.conf" >> $(FINAL_GENERATED_FILE); \
 		( \
 			echo "/lib/$(TARGET_TOOLCHAIN_TRIPLET)"; \
 			echo "/lib"; \
 			echo "/$(TARGET_DEFAULT_LIB_DESTDIR)/$(TARGET_TOOLCHAIN_TRIPLET)"; \
 			echo "/$(TARGET_DEFAULT_LIB_DESTDIR)"; \
 			$(foreach __d,$(TARGET_LDCONFIG_DIRS),echo "$(__d)";) \
-		) >> $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/ld.so.conf; \
+		) > $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/ld.so.conf; \
 	fi
-	$(Q) $(LDCONFIG) -X -r $(TARGET_OUT_FINAL)
+	$(Q) $(LDCONFIG) -X -r $(TARGET_OUT_FINAL) --elf-cache=$(ELF_CACHE_FILE) \
+		--manifest=$(LDCONFIG_MANIFEST_FILE) \
+		--stats=$(FINAL_STATS_DIR)/ldconfig.json
 ifneq ("$(_ld_so_preload_contents)","")
+# Files of the final tree can be hard links to staging (TARGET_FINAL_LINK_MODE),
+# break the link with a copy before modifying it
 	@( \
 		preload="$(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/ld.so.preload"; \
-		touch $${preload}; \
+		echo "$(TARGET_DEFAULT_ETC_DESTDIR)/ld.so.preload" >> $(FINAL_GENERATED_FILE); \
+		if [ -e $${preload} ]; then \
+			cp -p $${preload} $${preload}.tmp && mv -f $${preload}.tmp $${preload}; \
+		else \
+			touch $${preload}; \
+		fi; \
 		for entry in $(_ld_so_preload_contents); do \
 			if ! grep -q "$${entry}" $${preload}; then \
 				echo "$${entry}" >> $${preload}; \
@@ -147,9 +195,14 @@ endif
 endif
 endif
 ifeq ("$(is-full-system)","1")
-	$(Q) $(BUILD_SYSTEM)/scripts/checkdyndeps.py $(TARGET_OUT_FINAL)
-endif
-	@echo `date +%s` > $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/final.stamp
+	$(Q) $(BUILD_SYSTEM)/scripts/checkdyndeps.py $(TARGET_OUT_FINAL) \
+		--elf-cache=$(ELF_CACHE_FILE) \
+		--json=$(TARGET_OUT)/checkdyndeps.json \
+		--stats=$(FINAL_STATS_DIR)/checkdyndeps.json
+endif
+	@echo `date +%s` > $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/final.stamp.tmp
+	@mv -f $(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/final.stamp.tmp \
+		$(TARGET_OUT_FINAL)/$(TARGET_DEFAULT_ETC_DESTDIR)/final.stamp
 	@echo "Done generating final tree"
 
 .PHONY: final
@@ -49,9 +49,7 @@ define gen-image
 endef
 
 define gen-image-sparse
-	$(call gen-image,$1,$2.tmp,$3,$4)
-	$(Q) $(SPARSE_SCRIPT) --sparse $2.tmp $2
-	$(Q) rm -f $2.tmp
+	$(call gen-image,$1,$2,$3 --sparse,$4)
 endef
 
 define gen-image-verity
@@ -62,9 +60,9 @@ define gen-image-verity
 endef
 
 define gen-image-sparse-verity
-	$(call gen-image-verity,$1,$2.tmp,$3,$4)
-	$(Q) $(SPARSE_SCRIPT) --sparse $2.tmp $2
-	$(Q) rm -f $2.tmp
+	$(call gen-image-verity,$1,$2.tmp,$3 --manifest $2.manifest,$4)
+	$(Q) $(SPARSE_SCRIPT) --sparse --manifest $2.manifest $2.tmp $2
+	$(Q) rm -f $2.tmp $2.manifest
 endef
 
 ###############################################################################
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Measure the generation of the list of installed files by makefinal
+# (addPathInFileList) on the paths of a synthetic staging tree, compared to the
+# previous implementation recording directories in a list. Both shall write
+# the same file list.
+
+import sys, os, logging
+import argparse
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import makefinal
+
+#===============================================================================
+# Previous implementation: directories already logged in a list.
+#===============================================================================
+def addPathInFileListWithList(relPath, isDir, options):
+    parts = relPath.split("/")[:-1]
+    for i in range(0, len(parts)):
+        parentDir = "/".join(parts[0:i])
+        if parentDir != "" and parentDir not in options.fileListDirs:
+            options.fileListDirs.append(parentDir)
+            options.fileListFile.write("%s/\n" % parentDir)
+
+    if isDir:
+        if relPath not in options.fileListDirs:
+            options.fileListDirs.append(relPath)
+        relPath += "/"
+    options.fileListFile.write("%s\n" % relPath)
+
+#===============================================================================
+# Paths of files of a synthetic staging tree, in the order of a walk (files
+# of a directory before its sub-directories). Directories have a depth of 1
+# to 'maxDepth' and contain 'filesPerDir' files.
+#===============================================================================
+def genTreePaths(rnd, fileCount, filesPerDir, maxDepth):
+    paths = []
+    dirIdx = 0
+    stack = [""]
+    while len(paths) < fileCount:
+        if not stack:
+            stack = [""]
+        dirPath = stack.pop()
+        for i in range(0, filesPerDir):
+            paths.append(os.path.join(dirPath, "file%d" % i))
+        if dirPath.count("/") + 1 < maxDepth:
+            for _ in range(0, rnd.randint(1, 4)):
+                dirIdx += 1
+                stack.append(os.path.join(dirPath, "dir%d" % dirIdx))
+    return paths[:fileCount]
+
+#===============================================================================
+# Write the file list of 'paths' with the given function.
+# Returns (duration, content of the file list).
+#===============================================================================
+def genFileList(paths, func, fileListDirs, filePath):
+    options = argparse.Namespace()
+    options.fileListDirs = fileListDirs
+    with open(filePath, "w",
+            buffering=makefinal.FILELIST_BUFFER_SIZE) as fout:
+        options.fileListFile = fout
+        startTime = time.monotonic()
+        for path in paths:
+            func(path, False, options)
+        duration = time.monotonic() - startTime
+    with open(filePath, "r") as fin:
+        return (duration, fin.read())
+
+#===============================================================================
+# Main function.
+#===============================================================================
+def main():
+    options = parseArgs()
+    setupLog(options)
+    rnd = random.Random(options.seed)
+
+    paths = genTreePaths(rnd, options.files, options.filesPerDir,
+            options.maxDepth)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        filePath = os.path.join(tmpDir, "filelist.txt")
+        (setTime, setList) = genFileList(paths,
+                makefinal.addPathInFileList, set(), filePath)
+        (listTime, listList) = genFileList(paths,
+                addPathInFileListWithList, [], filePath)
+
+    dirCount = setList.count("/\n")
+    print("file list of %d files in %d directories: list %.3fs, set %.3fs" % (
+            len(paths), dirCount, listTime, setTime))
+    if setList != listList:
+        logging.error("File lists are different")
+        sys.exit(1)
+
+#===============================================================================
+# Setup option parser and parse command line.
+#===============================================================================
+def parseArgs():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed",
+        dest="seed",
+        type=int,
+        default=0,
+        help="seed of the random generator")
+    parser.add_argument("--files",
+        dest="files",
+        type=int,
+        default=200000,
+        help="number of files of the staging tree (default: 200000)")
+    parser.add_argument("--files-per-dir",
+        dest="filesPerDir",
+        type=int,
+        default=8,
+        help="number of files per directory (default: 8)")
+    parser.add_argument("--max-depth",
+        dest="maxDepth",
+        type=int,
+        default=6,
+        help="maximum depth of directories (default: 6)")
+    parser.add_argument("-q",
+        dest="quiet",
+        action="store_true",
+        default=False,
+        help="be quiet")
+    return parser.parse_args()
+
+#===============================================================================
+# Setup logging system.
+#===============================================================================
+def setupLog(options):
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="[%(levelname)s] %(message)s",
+        stream=sys.stderr)
+    logging.addLevelName(logging.CRITICAL, "C")
+    logging.addLevelName(logging.ERROR, "E")
+    logging.addLevelName(logging.WARNING, "W")
+    logging.addLevelName(logging.INFO, "I")
+    logging.addLevelName(logging.DEBUG, "D")
+
+    # setup log level
+    if options.quiet:
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+if __name__ == "__main__":
+    main()
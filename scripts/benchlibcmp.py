@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Check that Context.libcmp_key gives the same order as Context.libcmp (the
+# reference comparator) on random names, and measure the time to sort
+# synthetic SONAMEs with both.
+
+import sys, os, logging
+import argparse
+import functools
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import ldconfig
+
+# Characters used in random names, digits are more frequent to get numbers
+# of several digits (with leading zeros) next to text
+_NAME_CHARS = "0123456789" * 3 + "abcz.-_+~AZ"
+
+#===============================================================================
+#===============================================================================
+def sign(val):
+    return (val > 0) - (val < 0)
+
+#===============================================================================
+#===============================================================================
+def random_name(rnd):
+    return "".join(rnd.choice(_NAME_CHARS)
+            for _ in range(rnd.randint(0, 12)))
+
+#===============================================================================
+# Synthetic SONAMEs, with some duplicates as found in library directories.
+#===============================================================================
+def random_soname(rnd):
+    name = "lib%s.so" % "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz-_")
+            for _ in range(rnd.randint(1, 10)))
+    for _ in range(rnd.randint(0, 3)):
+        name += ".%d" % rnd.randint(0, 120)
+    return name
+
+#===============================================================================
+# Compare random pairs of names (and some prefixes of each other).
+# Returns the number of mismatches.
+#===============================================================================
+def check_equivalence(rnd, count):
+    mismatches = 0
+    for _ in range(count):
+        name1 = random_name(rnd)
+        name2 = random_name(rnd) if rnd.random() < 0.8 \
+                else name1[:rnd.randint(0, len(name1))] + random_name(rnd)
+        expected = sign(ldconfig.Context.libcmp(name1, name2))
+        key1 = ldconfig.Context.libcmp_key(name1)
+        key2 = ldconfig.Context.libcmp_key(name2)
+        result = (key1 > key2) - (key1 < key2)
+        if result != expected:
+            logging.error("Mismatch: '%s' '%s': libcmp=%d key=%d",
+                    name1, name2, expected, result)
+            mismatches += 1
+    return mismatches
+
+#===============================================================================
+# Sort libraries as ldconfig does, with Library.cmp (reference) and with the
+# precomputed key. Returns False if the orders differ.
+#===============================================================================
+def check_sort(rnd, count):
+    libs = [ldconfig.Library("/lib", "f", random_soname(rnd),
+            rnd.choice([0x0303, 0x0503]), rnd.randint(0, 3), rnd.randint(0, 3))
+            for _ in range(count)]
+    expected = sorted(libs, key=functools.cmp_to_key(
+            lambda lib1, lib2: lib1.cmp(lib2)), reverse=True)
+    result = sorted(libs, key=lambda lib: lib.sort_key, reverse=True)
+    return [lib.sort_key for lib in expected] == \
+            [lib.sort_key for lib in result]
+
+#===============================================================================
+#===============================================================================
+def bench(rnd, count):
+    sonames = [random_soname(rnd) for _ in range(count)]
+
+    start_time = time.monotonic()
+    expected = sorted(sonames, key=functools.cmp_to_key(ldconfig.Context.libcmp))
+    cmp_time = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    result = sorted(sonames, key=ldconfig.Context.libcmp_key)
+    key_time = time.monotonic() - start_time
+
+    # Equal names can be in any order, compare the keys
+    if [ldconfig.Context.libcmp_key(name) for name in expected] != \
+            [ldconfig.Context.libcmp_key(name) for name in result]:
+        logging.error("Sort mismatch")
+        return False
+    print("sort %d sonames: libcmp %.3fs, libcmp_key %.3fs" % (
+            count, cmp_time, key_time))
+    return True
+
+#===============================================================================
+# Main function.
+#===============================================================================
+def main():
+    options = parse_args()
+    setup_log(options)
+    rnd = random.Random(options.seed)
+
+    mismatches = check_equivalence(rnd, options.pairs)
+    print("compare %d random pairs: %d mismatches" % (options.pairs, mismatches))
+    result = (mismatches == 0)
+    if not check_sort(rnd, options.libs):
+        logging.error("Libraries sorted differently")
+        result = False
+    else:
+        print("sort %d libraries: same order" % options.libs)
+    if options.sonames > 0:
+        result = bench(rnd, options.sonames) and result
+    if not result:
+        sys.exit(1)
+
+#===============================================================================
+# Setup option parser and parse command line.
+#===============================================================================
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed",
+        type=int,
+        default=0,
+        help="Seed of the random generator.")
+    parser.add_argument("--pairs",
+        type=int,
+        default=300000,
+        help="Number of random pairs of names to compare (default: 300000).")
+    parser.add_argument("--libs",
+        type=int,
+        default=10000,
+        help="Number of random libraries to sort (default: 10000).")
+    parser.add_argument("--sonames",
+        type=int,
+        default=100000,
+        help="Number of synthetic SONAMEs to sort in the benchmark, 0 to "
+            "skip it (default: 100000).")
+    parser.add_argument("-q",
+        dest="quiet",
+        action="store_true",
+        default=False,
+        help="Be quiet.")
+    return parser.parse_args()
+
+#===============================================================================
+# Setup logging system.
+#===============================================================================
+def setup_log(options):
+    logging.basicConfig(
+            level=logging.WARNING,
+            format="[%(levelname)s] %(message)s",
+            stream=sys.stderr)
+    logging.addLevelName(logging.CRITICAL, "C")
+    logging.addLevelName(logging.ERROR, "E")
+    logging.addLevelName(logging.WARNING, "W")
+    logging.addLevelName(logging.INFO, "I")
+    logging.addLevelName(logging.DEBUG, "D")
+
+    # setup log level
+    if options.quiet:
+        logging.getLogger().setLevel(logging.CRITICAL)
+
+if __name__ == "__main__":
+    main()
@@ -2,51 +2,277 @@
 
 import sys, os, logging
 import argparse
+import glob
+import json
 
 import libelf
+import elfcache
+import host
+import stats
 
-#===============================================================================
-#===============================================================================
-class Context(object):
-    def __init__(self):
-        self.binaries = {}
-        self.libraries = {}
+# Directories searched by the loader after the ones of ld.so.conf
+DEFAULT_LIB_DIRS = ["/lib", "/usr/lib", "/lib64", "/usr/lib64"]
+
+# Directories not walked
+EXCLUDED_DIRS = ["proc", "sys", "dev"]
+
+# Max number of symbolic links followed when resolving a path
+MAX_LINK_DEPTH = 40
 
 #===============================================================================
-# Determine if a file is an elf file.
+# Elf file found in the root directory (path is relative to the root).
 #===============================================================================
-def isElf(filePath):
-    try:
-        with open(filePath, "rb") as fd:
-            if fd.read(4) == b"\x7fELF":
-                return True
-    except IOError as ex:
-        logging.error("Failed to open file: %s ([err=%d] %s)",
-            filePath, ex.errno, ex.strerror)
-    return False
+class ElfFile(object):
+    def __init__(self, path, info):
+        self.path = path
+        self.info = info
+        self.origin = os.path.dirname(path)
+
+    def isExec(self):
+        return self.info.hasInterp
+
+    # Get the directories listed in a DT_RPATH/DT_RUNPATH entry
+    def getSearchDirs(self, value):
+        if value is None:
+            return []
+        dirs = []
+        for dirPath in value.split(":"):
+            dirPath = dirPath.replace("${ORIGIN}", self.origin)
+            dirPath = dirPath.replace("$ORIGIN", self.origin)
+            if dirPath:
+                dirs.append(dirPath)
+        return dirs
 
 #===============================================================================
 #===============================================================================
-def processFile(ctx, filePath):
-    logging.info("Processing file : %s", filePath)
-    elf = libelf.Elf()
-    try:
-        elf.loadFromFile(filePath)
-        libraries = []
-        for dynEntry in elf.dynamicEntries:
-            if dynEntry.d_tag == libelf.DT_NEEDED \
-                    and dynEntry.valstr not in libraries:
-                libraries.append(dynEntry.valstr)
-            if dynEntry.d_tag == libelf.DT_RPATH:
-                logging.warning("%s: uses DT_RPATH '%s'",
-                        filePath, dynEntry.valstr)
-        ctx.binaries[filePath] = libraries
-        for lib in libraries:
-            if lib not in ctx.libraries:
-                ctx.libraries[lib] = False
-        elf.close()
-    except libelf.ElfError as ex:
-        logging.error("%s: %s)", filePath, ex)
+class Context(object):
+    def __init__(self, options):
+        self.options = options
+        self.rootDir = options.rootDir
+        self.elfCache = elfcache.ElfCache(options.elfCachePath)
+        self.stats = stats.Stats(options.statsPath)
+        # Elf files indexed by path (relative to root)
+        self.files = {}
+        # Target of symbolic links indexed by path (relative to root)
+        self.links = {}
+        # Paths of elf files needing a library indexed by SONAME
+        self.consumers = {}
+        # Directories from ld.so.conf
+        self.libDirs = []
+        # Missing libraries: SONAME -> consumer -> set of executables
+        self.missing = {}
+        self._realPaths = {}
+        self._resolved = {}
+
+    def getHostPath(self, path):
+        return os.path.join(self.rootDir, path.lstrip("/"))
+
+    # Walk the root directory once, recording symbolic links and elf files.
+    # Elf files are parsed by a pool of processes while walking.
+    def scan(self):
+        filePaths = []
+        self.elfCache.prefetch(self.walk(filePaths), self.options.jobs)
+        for filePath in sorted(filePaths):
+            self.processFile(filePath)
+
+    # Walk the root directory, recording symbolic links and adding regular
+    # files to 'filePaths'. Generate the host path of regular files.
+    def walk(self, filePaths):
+        dirPaths = ["/"]
+        while dirPaths:
+            dirPath = dirPaths.pop()
+            try:
+                entries = list(os.scandir(self.getHostPath(dirPath)))
+            except OSError as ex:
+                logging.error("Failed to scan directory: %s ([err=%d] %s)",
+                    dirPath, ex.errno, ex.strerror)
+                continue
+            for entry in entries:
+                path = os.path.join(dirPath, entry.name)
+                if entry.is_symlink():
+                    self.links[path] = os.readlink(entry.path)
+                elif entry.is_dir():
+                    if entry.name not in EXCLUDED_DIRS:
+                        dirPaths.append(path)
+                elif entry.is_file():
+                    filePaths.append(path)
+                    yield entry.path
+
+    def processFile(self, filePath):
+        hostPath = self.getHostPath(filePath)
+        try:
+            info = self.elfCache.getInfo(hostPath)
+        except libelf.ElfError as ex:
+            logging.error("%s: %s)", hostPath, ex)
+            return
+        except IOError as ex:
+            logging.error("Failed to open file: %s ([err=%d] %s)",
+                hostPath, ex.errno, ex.strerror)
+            return
+
+        # Not an elf file
+        if info is None:
+            return
+
+        logging.info("Processing file : %s", hostPath)
+        self.stats.addAction("elf", os.path.getsize(hostPath))
+        if info.rpath is not None:
+            logging.warning("%s: uses DT_RPATH '%s'", hostPath, info.rpath)
+        self.files[filePath] = ElfFile(filePath, info)
+        for lib in info.needed:
+            self.consumers.setdefault(lib, []).append(filePath)
+
+    def parseConf(self, confPath):
+        hostPath = self.getHostPath(confPath)
+        if not os.path.exists(hostPath):
+            return
+        logging.info("Parsing conf file '%s'", hostPath)
+        with open(hostPath, "r") as fin:
+            for line in fin:
+                # Remove comments, replace tabs by spaces and strip
+                line = line.split("#", 1)[0].replace("\t", " ").strip()
+                if line.startswith("include "):
+                    for pattern in line[8:].split(" "):
+                        for filePath in sorted(glob.glob(
+                                self.getHostPath(pattern))):
+                            self.parseConf("/" + os.path.relpath(
+                                    filePath, self.rootDir))
+                elif line and not line.startswith("hwcap "):
+                    line = line.split("=", 1)[0]
+                    if line not in self.libDirs:
+                        self.libDirs.append(line)
+
+    # Resolve symbolic links of a path inside the root directory.
+    # Returns None if a loop is detected.
+    def getRealPath(self, path, depth=0):
+        if path in self._realPaths:
+            return self._realPaths[path]
+        if depth > MAX_LINK_DEPTH:
+            return None
+        result = ""
+        for name in path.split("/"):
+            if name == "" or name == ".":
+                continue
+            elif name == "..":
+                result = result.rsplit("/", 1)[0]
+                continue
+            target = self.links.get(result + "/" + name, None)
+            if target is None:
+                result = result + "/" + name
+            else:
+                if not target.startswith("/"):
+                    target = result + "/" + target
+                result = self.getRealPath(target, depth + 1)
+                if result is None:
+                    return None
+                result = result.rstrip("/")
+        result = result or "/"
+        self._realPaths[path] = result
+        return result
+
+    # Find the library loaded for a SONAME needed by an elf file.
+    # 'rpathDirs' are the DT_RPATH directories inherited from the loaders.
+    # Returns the found ElfFile or None.
+    def findLibrary(self, elfFile, soname, rpathDirs):
+        key = (elfFile.path, soname, tuple(rpathDirs))
+        if key in self._resolved:
+            return self._resolved[key]
+
+        if "/" in soname:
+            candidates = [soname]
+        else:
+            # DT_RPATH is not used if there is a DT_RUNPATH
+            searchDirs = []
+            if elfFile.info.runpath is None:
+                searchDirs += elfFile.getSearchDirs(elfFile.info.rpath)
+                searchDirs += rpathDirs
+            searchDirs += elfFile.getSearchDirs(elfFile.info.runpath)
+            searchDirs += self.libDirs + DEFAULT_LIB_DIRS
+            candidates = [os.path.join(dirPath, soname)
+                    for dirPath in searchDirs]
+
+        result = None
+        for candidate in candidates:
+            lib = self.files.get(self.getRealPath(candidate), None)
+            # Libraries for another architecture are skipped by the loader
+            if lib is not None \
+                    and lib.info.e_machine == elfFile.info.e_machine \
+                    and lib.info.elfClass == elfFile.info.elfClass:
+                result = lib
+                break
+        self._resolved[key] = result
+        return result
+
+    # Load the dependencies of an elf file (and their dependencies) the way
+    # the loader does and record missing libraries.
+    def checkClosure(self, rootFile):
+        execPath = rootFile.path if rootFile.isExec() else None
+        loaded = {}
+        queue = [(rootFile, [])]
+        visited = set([rootFile.path])
+        while queue:
+            (elfFile, rpathDirs) = queue.pop(0)
+            # DT_RPATH of loaders is used for dependencies of dependencies
+            if elfFile.info.runpath is None:
+                childRpathDirs = elfFile.getSearchDirs(elfFile.info.rpath) + \
+                        rpathDirs
+            else:
+                childRpathDirs = rpathDirs
+            for soname in elfFile.info.needed:
+                # Already loaded by someone else
+                if soname in loaded:
+                    continue
+                lib = self.findLibrary(elfFile, soname, rpathDirs)
+                if lib is None:
+                    self.addMissing(soname, elfFile.path, execPath)
+                    continue
+                loaded[soname] = lib
+                if lib.info.soname is not None:
+                    loaded[lib.info.soname] = lib
+                if lib.path not in visited:
+                    visited.add(lib.path)
+                    queue.append((lib, childRpathDirs))
+        return visited
+
+    def addMissing(self, soname, consumer, execPath):
+        execPaths = self.missing.setdefault(soname, {}).setdefault(
+                consumer, set())
+        if execPath is not None:
+            execPaths.add(execPath)
+
+    # Check executables with their full closure, then other elf files
+    # (plugins, unused libraries) that were not loaded by any executable.
+    def check(self):
+        checked = set()
+        for filePath in sorted(self.files.keys()):
+            elfFile = self.files[filePath]
+            if elfFile.isExec():
+                checked |= self.checkClosure(elfFile)
+        for filePath in sorted(self.files.keys()):
+            elfFile = self.files[filePath]
+            if filePath not in checked and elfFile.info.needed:
+                checked |= self.checkClosure(elfFile)
+
+    def report(self):
+        for soname in sorted(self.missing.keys()):
+            consumers = self.missing[soname]
+            logging.warning("Missing library: '%s' needed by %s", soname,
+                    ", ".join(sorted(consumers.keys())))
+            for consumer in sorted(consumers.keys()):
+                for execPath in sorted(consumers[consumer]):
+                    if execPath != consumer:
+                        logging.info("  %s loaded by %s", consumer, execPath)
+
+        if self.options.jsonPath:
+            data = {}
+            for soname, consumers in self.missing.items():
+                data[soname] = {
+                    "neededBy": sorted(consumers.keys()),
+                    "executables": sorted(set().union(*consumers.values())),
+                    "consumers": sorted(self.consumers.get(soname, [])),
+                }
+            with open(self.options.jsonPath, "w") as fout:
+                json.dump({"missing": data}, fout, indent=4, sort_keys=True)
 
 #===============================================================================
 #===============================================================================
@@ -54,35 +280,25 @@ def main():
     options = parseArgs()
     setupLog(options)
 
-    ctx = Context()
+    ctx = Context(options)
 
     # Process all ELF files in given root directory
-    for (dirPath, dirNames, fileNames) in os.walk(options.rootDir):
-        for excludeDir in ["proc", "sys", "dev"]:
-            if excludeDir in dirNames:
-                dirNames.remove(excludeDir)
-        for fileName in fileNames:
-            filePath = os.path.join(dirPath, fileName)
-            if os.path.islink(filePath) or not isElf(filePath):
-                continue
-            processFile(ctx, filePath)
-
-    # Determine missing libraries
-    for (dirPath, dirNames, fileNames) in os.walk(options.rootDir):
-        for fileName in fileNames:
-            if fileName in ctx.libraries:
-                ctx.libraries[fileName] = True
-
-    # Print result
-    for library in ctx.libraries:
-        if not ctx.libraries[library]:
-            # Only display the first binary that needs the library
-            neededBy = None
-            for binary in ctx.binaries:
-                if library in ctx.binaries[binary]:
-                    neededBy = binary
-                    break
-            logging.warning("Missing library: '%s' needed by %s", library, neededBy)
+    ctx.scan()
+    ctx.elfCache.save()
+    ctx.stats.endPhase("scan")
+
+    # Resolve dependencies and print result
+    ctx.parseConf(options.confPath)
+    ctx.check()
+    ctx.stats.endPhase("check")
+    ctx.report()
+    ctx.stats.endPhase("report")
+
+    ctx.stats.addAction("elf-cache-misses", count=ctx.elfCache.misses)
+    ctx.stats.addAction("elf-cache-hits", count=ctx.elfCache.hits)
+    ctx.stats.addAction("missing", count=len(ctx.missing))
+    ctx.stats.addProcess(ctx.elfCache.processes)
+    ctx.stats.save()
 
 #===============================================================================
 # Setup option parser and parse command line.
@@ -95,6 +311,39 @@ def parseArgs():
             default=os.getcwd(),
             help="Root directoty to check")
 
+    parser.add_argument("--elf-cache",
+        dest="elfCachePath",
+        default=None,
+        metavar="FILE",
+        help="file where to cache information extracted from elf files")
+
+    parser.add_argument("-f", "--conf",
+        dest="confPath",
+        default="/etc/ld.so.conf",
+        metavar="CONF",
+        help="loader configuration file (relative to root directory)")
+
+    parser.add_argument("-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=host.getMakeJobs(),
+        metavar="N",
+        help="number of processes used to parse elf files "
+            "(default: number of jobs of make)")
+
+    parser.add_argument("--json",
+        dest="jsonPath",
+        default=None,
+        metavar="FILE",
+        help="file where to save missing libraries in json format")
+
+    parser.add_argument("--stats",
+        dest="statsPath",
+        default=None,
+        metavar="FILE",
+        help="file where to save statistics (time per phase, parsed files) "
+            "in json format")
+
     parser.add_argument("-q",
         dest="quiet",
         action="store_true",
@@ -0,0 +1,360 @@
+#===============================================================================
+# Persistent cache of information extracted from elf files.
+#
+# Entries are indexed by file path and validated with the (size, mtime, inode)
+# of the file so untouched files are not opened/parsed again by the next run.
+#===============================================================================
+
+import os, logging
+import hashlib
+import json
+import multiprocessing
+import struct
+import threading
+import time
+
+import libelf
+
+# Increment when the content of entries changes
+CACHE_VERSION = 1
+
+# Number of files given at once to a process of the pool
+PREFETCH_BATCH_SIZE = 32
+
+# Minimum time (in seconds) between two checks of entries of files that do not
+# exist anymore
+PRUNE_INTERVAL = 24 * 3600
+
+#===============================================================================
+# Information extracted from an elf file.
+#===============================================================================
+class ElfInfo(object):
+    def __init__(self):
+        self.e_type = libelf.ET_NONE
+        self.e_machine = libelf.EM_NONE
+        self.e_flags = 0
+        self.elfClass = libelf.ELFCLASSNONE
+        self.soname = None
+        self.needed = []
+        self.rpath = None
+        self.runpath = None
+        self.osversion = 0
+        self.hasInterp = False
+        self.hasDynamic = False
+        self.hasSymTab = False
+        self.hasDebug = False
+        self.hashes = {}
+
+    def is32Bit(self):
+        return self.elfClass == libelf.ELFCLASS32
+    def is64Bit(self):
+        return self.elfClass == libelf.ELFCLASS64
+
+    # True if the file has neither a symbol table nor debug sections.
+    def isStripped(self):
+        return not self.hasSymTab and not self.hasDebug
+
+    def toDict(self):
+        return dict(self.__dict__)
+
+    @staticmethod
+    def fromDict(data):
+        info = ElfInfo()
+        for key, val in data.items():
+            if key in info.__dict__:
+                setattr(info, key, val)
+        return info
+
+    @staticmethod
+    def fromElf(elf):
+        info = ElfInfo()
+        info.e_type = elf.ehdr.e_type
+        info.e_machine = elf.ehdr.e_machine
+        info.e_flags = elf.ehdr.e_flags
+        info.elfClass = elf.ehdr.e_ident[libelf.EI_CLASS]
+
+        for phdr in elf.phdrTable:
+            if phdr.p_type == libelf.PT_INTERP:
+                info.hasInterp = True
+            elif phdr.p_type == libelf.PT_DYNAMIC:
+                info.hasDynamic = True
+
+        for dynEntry in elf.dynamicEntries:
+            if dynEntry.d_tag == libelf.DT_NEEDED:
+                if dynEntry.valstr not in info.needed:
+                    info.needed.append(dynEntry.valstr)
+            elif dynEntry.d_tag == libelf.DT_SONAME:
+                info.soname = dynEntry.valstr
+            elif dynEntry.d_tag == libelf.DT_RPATH:
+                info.rpath = dynEntry.valstr
+            elif dynEntry.d_tag == libelf.DT_RUNPATH:
+                info.runpath = dynEntry.valstr
+
+        for shdr in elf.shdrTable:
+            if shdr.sh_type == libelf.SHT_SYMTAB:
+                # First entry is always the null symbol
+                symSize = libelf.ElfSym.size32 if info.is32Bit() \
+                        else libelf.ElfSym.size64
+                if shdr.sh_size > symSize:
+                    info.hasSymTab = True
+            elif shdr.sh_type == libelf.SHT_NOTE \
+                    and shdr.namestr == ".note.ABI-tag":
+                info.osversion = _extractOsVersion(elf, shdr)
+            elif shdr.namestr is not None \
+                    and shdr.namestr.startswith(".debug"):
+                info.hasDebug = True
+        return info
+
+#===============================================================================
+# Extract os version from the '.note.ABI-tag' section.
+#===============================================================================
+def _extractOsVersion(elf, shdr):
+    data = elf.getSectionData(shdr)
+    if len(data) >= 32:
+        fmt = elf.ehdr.getFmtPrefix() + "IIIIIIII"
+        words = struct.unpack(fmt, data[0:32])
+        if words[0] == 4 and words[1] == 16 and \
+                words[2] == 1 and words[3] == 0x554e47:
+            return (words[4] << 24) | (words[5] << 16) | \
+                    (words[6] << 8) | words[7]
+    return 0
+
+#===============================================================================
+# Get the data used to check that a cache entry is still valid.
+#===============================================================================
+def _getStat(filePath):
+    st = os.stat(filePath)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+#===============================================================================
+# Only entries of elf files (valid or not) are saved, other files are only
+# remembered during a run.
+#===============================================================================
+def _isElfEntry(entry):
+    return entry["info"] is not None or entry["error"] is not None
+
+#===============================================================================
+# Load a file and create its cache entry. It shall be a global function
+# so it can be used by a process pool.
+#===============================================================================
+def _loadEntry(filePath):
+    entry = {"stat": _getStat(filePath), "info": None, "error": None}
+    with open(filePath, "rb") as fin:
+        isElf = (fin.read(4) == b"\x7fELF")
+    if isElf:
+        elf = libelf.Elf()
+        try:
+            elf.loadFromFile(filePath, lazy=True)
+            entry["info"] = ElfInfo.fromElf(elf).toDict()
+        except libelf.ElfError as ex:
+            entry["error"] = str(ex)
+        finally:
+            elf.close()
+    return entry
+
+#===============================================================================
+# Same as _loadEntry but returns None if the file can not be read (removed since
+# it was listed, not readable...), the error is reported when it is used.
+#===============================================================================
+def _prefetchEntry(filePath):
+    try:
+        return _loadEntry(filePath)
+    except OSError as ex:
+        logging.debug("Failed to prefetch '%s': %s", filePath, ex)
+        return None
+
+#===============================================================================
+# Cache of ElfInfo, optionally saved in a file.
+# It can be used by several threads (makefinal copies files with a thread pool).
+#===============================================================================
+class ElfCache(object):
+    def __init__(self, filePath=None):
+        self.filePath = filePath
+        # Protects entries, dirty, hits, misses and keyLocks
+        self.lock = threading.Lock()
+        # Held while a file is loaded or hashed so it is only done once
+        self.keyLocks = {}
+        self.entries = {}
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        # Number of processes started to parse files
+        self.processes = 0
+        if self.filePath is not None:
+            (self.entries, _) = ElfCache._load(self.filePath)
+
+    # Get information about a file.
+    # Returns None if it is not an elf file, raise libelf.ElfError if it is
+    # an invalid elf file.
+    def getInfo(self, filePath):
+        key = os.path.abspath(filePath)
+        with self._getKeyLock(key):
+            entry = self._getEntry(key)
+        if entry.get("error", None) is not None:
+            raise libelf.ElfError(entry["error"])
+        elif entry.get("info", None) is None:
+            return None
+        else:
+            return ElfInfo.fromDict(entry["info"])
+
+    # Get the hash of loadable sections of the file (see libelf.computeHash)
+    # Returns None if it is not a valid elf file.
+    def getHash(self, filePath, hashName="md5"):
+        key = os.path.abspath(filePath)
+        with self._getKeyLock(key):
+            entry = self._getEntry(key)
+            info = entry.get("info", None)
+            if info is None:
+                return None
+            if hashName not in info["hashes"]:
+                elf = libelf.Elf()
+                try:
+                    elf.loadFromFile(filePath, lazy=True)
+                    info["hashes"][hashName] = \
+                            elf.computeHash(hashlib.new(hashName))
+                except libelf.ElfError as ex:
+                    logging.error("%s: %s", filePath, ex)
+                    return None
+                finally:
+                    elf.close()
+                with self.lock:
+                    self.dirty.add(key)
+            return info["hashes"][hashName]
+
+    # Get the hash of the whole content of the file.
+    def getFileHash(self, filePath, hashName="sha1"):
+        key = os.path.abspath(filePath)
+        with self._getKeyLock(key):
+            entry = self._getEntry(key)
+            fileHashes = entry.setdefault("fileHashes", {})
+            if hashName not in fileHashes:
+                fileHash = hashlib.new(hashName)
+                with open(key, "rb") as fin:
+                    for data in iter(lambda: fin.read(1024 * 1024), b""):
+                        fileHash.update(data)
+                fileHashes[hashName] = fileHash.hexdigest()
+                with self.lock:
+                    self.dirty.add(key)
+            return fileHashes[hashName]
+
+    # Shall not be called while other threads use the cache.
+    def save(self):
+        if self.filePath is None or not self.dirty:
+            return
+
+        # Merge with entries saved by someone else in the meantime
+        (entries, pruneTime) = ElfCache._load(self.filePath)
+        for key in self.dirty:
+            if _isElfEntry(self.entries[key]):
+                entries[key] = self.entries[key]
+
+        # Forget about files that do not exist anymore, not at each save
+        # to avoid checking all the entries each time
+        now = time.time()
+        if now - pruneTime >= PRUNE_INTERVAL:
+            for key in list(entries.keys()):
+                if not os.path.exists(key):
+                    del entries[key]
+            pruneTime = now
+
+        # Save in a temp file and rename to final path
+        logging.debug("Saving elf cache '%s' (%d hits, %d misses)",
+                self.filePath, self.hits, self.misses)
+        try:
+            tmpFilePath = "%s.%d.tmp" % (self.filePath, os.getpid())
+            with open(tmpFilePath, "w") as fout:
+                json.dump({"version": CACHE_VERSION, "pruneTime": pruneTime,
+                        "entries": entries}, fout)
+            os.rename(tmpFilePath, self.filePath)
+        except IOError as ex:
+            logging.warning("Failed to save elf cache: %s [err=%d %s]",
+                    self.filePath, ex.errno, ex.strerror)
+        self.dirty = set()
+
+    # Make sure that information about the given files is in the cache.
+    # Files not in the cache (or modified) are parsed by a pool of 'jobs'
+    # processes if more than one is requested. 'filePaths' can be a generator,
+    # files are given by batches to the pool while it produces them.
+    def prefetch(self, filePaths, jobs=1):
+        pool = None
+        results = []
+        batch = []
+        try:
+            for filePath in filePaths:
+                key = os.path.abspath(filePath)
+                entry = self.entries.get(key, None)
+                try:
+                    if entry is not None and entry["stat"] == _getStat(key):
+                        continue
+                except OSError:
+                    # Reported when it is used
+                    continue
+                if jobs <= 1:
+                    entry = _prefetchEntry(key)
+                    if entry is not None:
+                        self._addEntry(key, entry)
+                    continue
+                batch.append(key)
+                if len(batch) >= PREFETCH_BATCH_SIZE:
+                    if pool is None:
+                        logging.debug("Parsing elf files with %d jobs", jobs)
+                        pool = multiprocessing.Pool(jobs)
+                        self.processes += jobs
+                    results.append((batch,
+                            pool.map_async(_prefetchEntry, batch)))
+                    batch = []
+
+            # Remaining files, no need to start a pool for a few of them
+            if pool is not None:
+                results.append((batch, pool.map_async(_prefetchEntry, batch)))
+            else:
+                results.append((batch, None))
+            for (keys, result) in results:
+                entries = result.get() if result is not None \
+                        else [_prefetchEntry(key) for key in keys]
+                for (key, entry) in zip(keys, entries):
+                    if entry is not None:
+                        self._addEntry(key, entry)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _addEntry(self, key, entry):
+        with self.lock:
+            self.misses += 1
+            self.entries[key] = entry
+            self.dirty.add(key)
+
+    # Lock to hold while using the entry of a file (reentrant as methods
+    # holding it call each other)
+    def _getKeyLock(self, key):
+        with self.lock:
+            return self.keyLocks.setdefault(key, threading.RLock())
+
+    # The lock of the key shall be held.
+    def _getEntry(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+        if entry is not None and entry["stat"] == _getStat(key):
+            with self.lock:
+                self.hits += 1
+            return entry
+
+        # Load file and extract information
+        entry = _loadEntry(key)
+        self._addEntry(key, entry)
+        return entry
+
+    # Returns the entries and the last time they were pruned
+    @staticmethod
+    def _load(filePath):
+        try:
+            with open(filePath, "r") as fin:
+                data = json.load(fin)
+            if data.get("version", None) == CACHE_VERSION:
+                return (data["entries"], data.get("pruneTime", 0))
+            logging.debug("Ignoring elf cache '%s': version mismatch", filePath)
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+        return ({}, 0)
@@ -5,6 +5,9 @@ import logging
 import os
 import py_compile
 import sys
+import time
+
+import stats
 
 #===============================================================================
 #===============================================================================
@@ -16,8 +19,9 @@ def is_python_file(filepath):
 
 #===============================================================================
 #===============================================================================
-def compile_file(filepath, sysroot):
+def compile_file(filepath, sysroot, report, generated):
     logging.debug("Compiling '%s'", filepath)
+    start_time = time.monotonic()
 
     dstpath = filepath + "c"
 
@@ -27,12 +31,21 @@ def compile_file(filepath, sysroot):
     else:
         runpath = filepath
 
+    # Record it before generating it so it is known even in case of error
+    if generated:
+        generated.write("%s\t%s\n" % (
+                os.path.relpath(dstpath, sysroot), relpath))
+        generated.flush()
+
     py_compile.compile(filepath, cfile=dstpath, dfile=runpath, doraise=True, optimize=2)
 
     # Apply original file time to generated one
     st = os.stat(filepath)
     os.utime(dstpath, ns=(st.st_atime_ns, st.st_mtime_ns))
 
+    report.addAction("compile", st.st_size)
+    report.addOperation("compile", filepath, time.monotonic() - start_time)
+
 #===============================================================================
 # Main function.
 #===============================================================================
@@ -41,6 +54,14 @@ def main():
     setup_log(options)
 
     sysroot = options.sysroot and os.path.abspath(options.sysroot)
+    report = stats.Stats(options.stats)
+
+    generated = None
+    if options.generated:
+        if not sysroot:
+            logging.critical("--generated requires --sysroot")
+            sys.exit(1)
+        generated = open(options.generated, "a")
 
     try:
         for d in options.dirs:
@@ -50,10 +71,15 @@ def main():
                 for filename in filenames:
                     filepath = os.path.join(dirpath, filename)
                     if is_python_file(filepath):
-                        compile_file(filepath, sysroot)
+                        compile_file(filepath, sysroot, report, generated)
+            report.endPhase(d)
     except Exception as ex:
         logging.critical("Exception: %s", ex)
         sys.exit(1)
+    finally:
+        if generated:
+            generated.close()
+        report.save()
 
 
 #===============================================================================
@@ -71,6 +97,16 @@ def parse_args():
         metavar="DIR",
         help="System root prefix to remove from generated file names")
 
+    parser.add_argument("--stats",
+        metavar="FILE",
+        help="File where to save statistics (time, compiled files, slowest "
+            "compilations) in json format")
+
+    parser.add_argument("--generated",
+        metavar="FILE",
+        help="File where to append the generated files with the file they "
+            "are generated from (separated by a tab), relative to sysroot")
+
     parser.add_argument("-q",
         dest="quiet",
         action="store_true",
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-import sys
+import sys, os
+import multiprocessing
 import platform
 
 def getinfo(name):
@@ -22,6 +23,21 @@ def getinfo(name):
     else:
         return None
 
+# Get the number of jobs given to make (if we are called by it).
+def getMakeJobs():
+    args = os.environ.get("MAKEFLAGS", "").split()
+    for idx, arg in enumerate(args):
+        if arg.startswith("--jobs="):
+            return int(arg[7:])
+        elif arg.startswith("-j") and arg[2:].isdigit():
+            return int(arg[2:])
+        elif arg == "-j" or arg == "--jobs":
+            if idx + 1 < len(args) and args[idx + 1].isdigit():
+                return int(args[idx + 1])
+            # Unlimited
+            return multiprocessing.cpu_count()
+    return 1
+
 if __name__ == "__main__":
     def main():
         if len(sys.argv) != 2:
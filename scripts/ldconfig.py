@@ -2,12 +2,17 @@
 
 import sys, os, logging
 import argparse
+import bisect
 import ctypes
 import glob
+import json
 import mmap
+import re
 import struct
 
 import libelf
+import elfcache
+import stats
 
 LD_SO_CACHE = "/etc/ld.so.cache"
 LD_SO_CONF = "/etc/ld.so.conf"
@@ -144,6 +149,14 @@ CACHE_MAGIC = b"ld.so-1.7.0"
 CACHE_MAGIC_NEW = b"glibc-ld.so.cache"
 CACHE_VERSION = b"1.1"
 
+# Used to split names in text and numbers for Context.libcmp_key, the mark is
+# greater than any character that can be found in a name
+_LIBCMP_SPLIT_RE = re.compile(r"([0-9]+)")
+_LIBCMP_DIGIT_MARK = "\U0010ffff"
+
+# Increment when the content of the manifest changes
+MANIFEST_VERSION = 2
+
 class CacheHeader(ctypes.LittleEndianStructure):
     _fields_ = [
         ("magic", ctypes.c_char * 11),
@@ -180,6 +193,16 @@ class CacheEntryNew(ctypes.LittleEndianStructure):
     ]
 assert ctypes.sizeof(CacheEntryNew) == 24
 
+# Same layouts as above used to build the cache in a single buffer
+_CACHE_HEADER = struct.Struct("<11sBI")
+_CACHE_ENTRY = struct.Struct("<III")
+_CACHE_HEADER_NEW = struct.Struct("<17s3sII5I")
+_CACHE_ENTRY_NEW = struct.Struct("<IIIIQ")
+assert _CACHE_HEADER.size == ctypes.sizeof(CacheHeader)
+assert _CACHE_ENTRY.size == ctypes.sizeof(CacheEntry)
+assert _CACHE_HEADER_NEW.size == ctypes.sizeof(CacheHeaderNew)
+assert _CACHE_ENTRY_NEW.size == ctypes.sizeof(CacheEntryNew)
+
 #===============================================================================
 # Wrapper just to avoid errors with pylint saying that methods
 # from_buffer and from_address does not exist for class deriving from ctypes
@@ -191,6 +214,127 @@ def _from_buffer(cls, buf, off=0):
 def _from_address(cls, addr):
     return cls.from_address(addr)
 
+#===============================================================================
+# Build a string table with null-terminated strings.
+# Identical strings are stored once and a string that is the end of another
+# one points inside it.
+# Returns a tuple (strtable, offsets) with offsets being a dictionary
+# string -> offset in the table.
+#===============================================================================
+def _build_strtable(strings):
+    # Once sorted by reversed content, a string that is the end of other
+    # ones is immediately followed by the longest of them (after resolving
+    # chains from the end)
+    revstrings = sorted(set(string[::-1] for string in strings))
+    owners = [None] * len(revstrings)
+    for idx in range(len(revstrings) - 1, -1, -1):
+        if idx + 1 < len(revstrings) and \
+                revstrings[idx + 1].startswith(revstrings[idx]):
+            owners[idx] = owners[idx + 1]
+        else:
+            owners[idx] = idx
+
+    # Add strings that are not the end of another one
+    strtable = bytearray()
+    offsets = {}
+    for idx, revstring in enumerate(revstrings):
+        if owners[idx] == idx:
+            offsets[revstring[::-1]] = len(strtable)
+            strtable += revstring[::-1]
+            strtable += b"\0"
+
+    # Others point inside their owner
+    for idx, revstring in enumerate(revstrings):
+        if owners[idx] != idx:
+            owner = revstrings[owners[idx]][::-1]
+            offsets[revstring[::-1]] = offsets[owner] + \
+                    len(owner) - len(revstring)
+    return (bytes(strtable), offsets)
+
+#===============================================================================
+# Stat data used to detect changes since the previous run.
+#===============================================================================
+def _get_dir_stat(dirpath):
+    st = os.stat(dirpath)
+    return [st.st_mtime_ns, st.st_ino]
+
+def _get_file_stat(filepath):
+    st = os.stat(filepath)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _get_link_stat(filepath):
+    st = os.lstat(filepath)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+#===============================================================================
+# Read the entries of a cache from a buffer.
+# Returns a tuple (fmt, entries) with entries being a list of tuples
+# (soname, flags, osversion, hwcap, filepath) or (None, None) if the buffer
+# is not a valid cache. For the compat format, entries of the new cache
+# embedded in the old one are returned.
+#===============================================================================
+def _read_cache(buf):
+    # Get old header from buffer
+    def get_header(off=0):
+        if len(buf) < off + ctypes.sizeof(CacheHeader):
+            return None
+        header = _from_buffer(CacheHeader, buf, off)
+        if header.magic != CACHE_MAGIC:
+            return None
+        return header
+
+    # Get new header from buffer
+    def get_header_new(off=0):
+        if len(buf) < off + ctypes.sizeof(CacheHeaderNew):
+            return None
+        header_new = _from_buffer(CacheHeaderNew, buf, off)
+        if header_new.magic != CACHE_MAGIC_NEW:
+            return None
+        if header_new.version != CACHE_VERSION:
+            return None
+        return header_new
+
+    # Get a string from the buffer (they are null-terminated)
+    def get_string(off):
+        end = buf.find(b'\0', strtable_start + off)
+        if end == -1:
+            return ""
+        return buf[strtable_start+off:end].decode("UTF-8")
+
+    # Is it new format without the old one ?
+    header_new = get_header_new()
+    if header_new is not None:
+        fmt = FORMAT_NEW
+        entries_new = _from_buffer(CacheEntryNew * header_new.nlibs,
+                buf, ctypes.sizeof(CacheHeaderNew))
+        strtable_start = 0
+    else:
+        # Is it old format ?
+        header = get_header()
+        if header is None:
+            return (None, None)
+        fmt = FORMAT_OLD
+        entries = _from_buffer(CacheEntry * header.nlibs,
+                buf, ctypes.sizeof(CacheHeader))
+        off = ctypes.sizeof(CacheHeader) + \
+                header.nlibs * ctypes.sizeof(CacheEntry)
+        strtable_start = off
+
+        # Check for a new cache embedded in the old format
+        header_new = get_header_new(off)
+        if header_new is not None:
+            fmt = FORMAT_COMPAT
+            entries_new = _from_buffer(CacheEntryNew * header_new.nlibs,
+                    buf, off + ctypes.sizeof(CacheHeaderNew))
+
+    if fmt == FORMAT_OLD:
+        return (fmt, [(get_string(entry.key), entry.flags, 0, 0,
+                get_string(entry.value)) for entry in entries])
+    else:
+        return (fmt, [(get_string(entry_new.key), entry_new.flags,
+                entry_new.osversion, entry_new.hwcap,
+                get_string(entry_new.value)) for entry_new in entries_new])
+
 #===============================================================================
 #===============================================================================
 class Library(object):
@@ -208,6 +352,8 @@ class Library(object):
         for bit in range(0, 64):
             if (self.hwcap & (1 << bit)) != 0:
                 self.bits_hwcap += 1
+        self.sort_key = (Context.libcmp_key(self.soname), self.flags,
+                self.bits_hwcap, self.hwcap, self.osversion)
 
     def cmp(self, other):
         res = Context.libcmp(self.soname, other.soname)
@@ -225,7 +371,7 @@ class Library(object):
             return 0
 
     def __lt__(self, other):
-        return self.cmp(other) > 0
+        return self.sort_key > other.sort_key
 
 #===============================================================================
 #===============================================================================
@@ -238,6 +384,10 @@ class Context(object):
         self.libdirs_by_ino = {}
         self.hwcapdirs = []
         self.libs = []
+        self.elf_cache = elfcache.ElfCache(options.elf_cache)
+        self.manifest_filepath = options.manifest
+        self.manifest = {}
+        self.stats = stats.Stats(options.stats)
 
         self._hwcaps = {
             "x86": _HWCAPS_X86,
@@ -251,129 +401,196 @@ class Context(object):
         self._add_libdir("/lib")
         self._add_libdir("/lib64")
         self._add_libdir("/libx32")
+        self.stats.endPhase("conf")
+
+        # Scan directories (and hwcap sub-directories found on the way)
+        # Directories not modified since the previous run are taken from
+        # the manifest without looking at their files
+        old_manifest = self._load_manifest()
+        scanned = []
         while self.libdirs:
-            self._search_dir(self.libdirs.pop(0))
-        self.libs.sort()
+            libdir = self.libdirs.pop(0)
+            dirinfo = old_manifest.get(libdir, None)
+            if dirinfo is not None and self._is_dir_unchanged(libdir, dirinfo):
+                logging.info("Reusing directory '%s'",
+                        self._get_abs_path(libdir))
+                for subdir in dirinfo["subdirs"]:
+                    self._add_libdir(subdir)
+                self.stats.addAction("reuse-dir")
+            else:
+                dirinfo = self._scan_dir(libdir)
+                self.stats.addAction("scan-dir")
+            scanned.append((libdir, dirinfo))
+        self.stats.endPhase("scan")
+
+        # Parse all candidate files (in parallel if requested) and then
+        # process directories in order so the result does not depend on jobs
+        self.elf_cache.prefetch([
+                self._get_abs_path(os.path.join(libdir, filename))
+                for (libdir, dirinfo) in scanned if dirinfo["libs"] is None
+                for filename in dirinfo["files"]], self.options.jobs)
+        self.stats.endPhase("parse")
+        for (libdir, dirinfo) in scanned:
+            self._search_dir(libdir, dirinfo)
+            self.manifest[libdir] = dirinfo
+        self.libs.sort(key=lambda lib: lib.sort_key, reverse=True)
+        self.stats.addAction("lib", count=len(self.libs))
+        self.stats.endPhase("search")
 
     def save_cache(self):
+        # Nothing to do if the existing cache already has the same content
+        if self._is_cache_unchanged():
+            logging.info("Cache '%s' is up to date", self.cache_filepath)
+            return
+
         # Save in a temp file and rename to final path
         logging.info("Creating '%s'", self.cache_filepath)
         with open(self.cache_filepath + ".tmp", "wb") as fout:
             self._save_cache(fout)
         os.rename(self.cache_filepath + ".tmp", self.cache_filepath)
 
+    def save_manifest(self):
+        if not self.manifest_filepath:
+            return
+        logging.info("Saving manifest '%s'", self.manifest_filepath)
+        with open(self.manifest_filepath + ".tmp", "w") as fout:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "root": self.options.root_dirpath,
+                "arch": self.options.arch,
+                "dirs": self.manifest,
+            }, fout)
+        os.rename(self.manifest_filepath + ".tmp", self.manifest_filepath)
+
     def print_cache(self):
-        # Open read-only and map copy-on-write so we can use ctypes.from_buffer
-        # that requires writable buffer even if we will only read from it
-        with open(self.cache_filepath, "rb") as fin:
-            buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
-            self._print_cache(buf)
+        self._print_cache(CacheReader(self.cache_filepath))
+
+    def _load_manifest(self):
+        if not self.manifest_filepath:
+            return {}
+        try:
+            with open(self.manifest_filepath, "r") as fin:
+                data = json.load(fin)
+            if data.get("version", None) == MANIFEST_VERSION and \
+                    data.get("root", None) == self.options.root_dirpath and \
+                    data.get("arch", None) == self.options.arch:
+                return data["dirs"]
+            logging.debug("Ignoring manifest '%s': settings mismatch",
+                    self.manifest_filepath)
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+        return {}
+
+    def _is_dir_unchanged(self, libdir, dirinfo):
+        # Adding, removing or renaming entries changes the directory mtime,
+        # modified files are detected with their own stat
+        dirpath = self._get_abs_path(libdir)
+        try:
+            if _get_dir_stat(dirpath) != dirinfo["stat"]:
+                return False
+            for filename, filestat in dirinfo["files"].items():
+                if _get_file_stat(os.path.join(dirpath, filename)) != filestat:
+                    return False
+            # The target of a link can appear in another directory, a link
+            # that was dangling is scanned again once it can be resolved
+            for filename, linkstat in dirinfo["links"].items():
+                filepath = os.path.join(dirpath, filename)
+                if _get_link_stat(filepath) != linkstat:
+                    return False
+                if filename not in dirinfo["files"] and \
+                        os.path.exists(filepath):
+                    return False
+        except OSError:
+            return False
+        return True
+
+    # Get the entries that will be written in the cache in the given format.
+    def _get_cache_entries(self, fmt):
+        if fmt == FORMAT_OLD:
+            return [(lib.soname, lib.flags, 0, 0, lib.filepath)
+                    for lib in self.libs if lib.hwcap == 0]
+        else:
+            return [(lib.soname, lib.flags, lib.osversion, lib.hwcap,
+                    lib.filepath) for lib in self.libs]
+
+    def _is_cache_unchanged(self):
+        try:
+            reader = CacheReader(self.cache_filepath)
+        except IOError:
+            return False
+        return reader.fmt == self.options.fmt and \
+                reader.entries == self._get_cache_entries(reader.fmt)
 
     def _save_cache(self, fout):
-        total_strlen = 0
-        entry_count = 0
-        entry_count_new = 0
-        for lib in self.libs:
-            total_strlen += len(lib.soname_utf8) + len(lib.filepath_utf8) + 2
-            entry_count += 1 if lib.hwcap == 0 else 0
-            entry_count_new += 1
+        fout.write(self._build_cache())
+
+    # Build the content of the cache in a single buffer.
+    def _build_cache(self):
+        fmt = self.options.fmt
+
+        # SONAMEs are the end of the path of libraries so most of them will
+        # be merged in the string table
+        strtable, str_offsets = _build_strtable(
+                [lib.soname_utf8 for lib in self.libs] +
+                [lib.filepath_utf8 for lib in self.libs])
 
         # Duplicate last entry in compat mode if number of entries is odd.
         # This is to make sure that the new header that will follow will
         # be properly aligned on a 8-byte boundary
-        if self.options.fmt == FORMAT_COMPAT and entry_count % 2 == 1:
+        entry_count = sum(1 for lib in self.libs if lib.hwcap == 0)
+        entry_count_new = len(self.libs)
+        if fmt == FORMAT_COMPAT and entry_count % 2 == 1:
             duplicate_last_entry = True
             entry_count += 1
         else:
             duplicate_last_entry = False
 
-        # The start of string table is different based on format
-        strtable_start = 0
-        if self.options.fmt != FORMAT_OLD:
-            strtable_start += ctypes.sizeof(CacheHeaderNew)
-            strtable_start += entry_count_new * ctypes.sizeof(CacheEntryNew)
-
-        # Old format or compat
-        if self.options.fmt != FORMAT_NEW:
-            # Header
-            header = CacheHeader(magic=CACHE_MAGIC,
-                    _pad=0,
-                    nlibs=entry_count)
-            fout.write(header)
-
-            # Entries
-            str_offset = strtable_start
-            last_entry = None
-            for lib in self.libs:
-                if lib.hwcap == 0:
-                    entry = CacheEntry(flags=lib.flags,
-                            key=str_offset,
-                            value=str_offset+len(lib.soname_utf8)+1)
-                    fout.write(entry)
-                    last_entry = entry
-                str_offset += len(lib.soname_utf8) + len(lib.filepath_utf8) + 2
-
-            # Duplicate last entry if needed
-            if duplicate_last_entry:
-                fout.write(last_entry)
-
-        # New format or compat
-        if self.options.fmt != FORMAT_OLD:
-            # Header (shall be aligned on a 8-byte boundary)
-            header_new = CacheHeaderNew(magic=CACHE_MAGIC_NEW,
-                    version = CACHE_VERSION,
-                    nlibs=entry_count_new,
-                    len_strings=total_strlen,
-                    unused=(0, 0, 0, 0, 0))
-            assert fout.tell() % 8 == 0
-            fout.write(header_new)
-
-            # Entries
-            str_offset = strtable_start
-            for lib in self.libs:
-                entry_new = CacheEntryNew(flags=lib.flags,
-                        key=str_offset,
-                        value=str_offset+len(lib.soname_utf8)+1,
-                        osversion=lib.osversion,
-                        hwcap=lib.hwcap)
-                fout.write(entry_new)
-                str_offset += len(lib.soname_utf8) + len(lib.filepath_utf8) + 2
+        # Compute layout, the start of string table is different based on
+        # format (offsets are relative to the new header if any)
+        size_old = 0
+        if fmt != FORMAT_NEW:
+            size_old += ctypes.sizeof(CacheHeader)
+            size_old += entry_count * ctypes.sizeof(CacheEntry)
+        size_new = 0
+        if fmt != FORMAT_OLD:
+            size_new += ctypes.sizeof(CacheHeaderNew)
+            size_new += entry_count_new * ctypes.sizeof(CacheEntryNew)
+        strtable_start = size_new
+        buf = bytearray(size_old + size_new + len(strtable))
+
+        # Headers (new one shall be aligned on a 8-byte boundary)
+        if fmt != FORMAT_NEW:
+            _CACHE_HEADER.pack_into(buf, 0, CACHE_MAGIC, 0, entry_count)
+        if fmt != FORMAT_OLD:
+            assert size_old % 8 == 0
+            _CACHE_HEADER_NEW.pack_into(buf, size_old,
+                    CACHE_MAGIC_NEW, CACHE_VERSION,
+                    entry_count_new, len(strtable), 0, 0, 0, 0, 0)
+
+        # Entries
+        off = ctypes.sizeof(CacheHeader)
+        off_new = size_old + ctypes.sizeof(CacheHeaderNew)
+        for lib in self.libs:
+            key = strtable_start + str_offsets[lib.soname_utf8]
+            value = strtable_start + str_offsets[lib.filepath_utf8]
+            if fmt != FORMAT_NEW and lib.hwcap == 0:
+                _CACHE_ENTRY.pack_into(buf, off, lib.flags, key, value)
+                off += _CACHE_ENTRY.size
+            if fmt != FORMAT_OLD:
+                _CACHE_ENTRY_NEW.pack_into(buf, off_new,
+                        lib.flags, key, value, lib.osversion, lib.hwcap)
+                off_new += _CACHE_ENTRY_NEW.size
+
+        # Duplicate last entry if needed
+        if duplicate_last_entry:
+            buf[off:off + _CACHE_ENTRY.size] = \
+                    buf[off - _CACHE_ENTRY.size:off]
 
         # Strings
-        for lib in self.libs:
-            fout.write(lib.soname_utf8)
-            fout.write(b"\0")
-            fout.write(lib.filepath_utf8)
-            fout.write(b"\0")
-
-    def _print_cache(self, buf):
-        # Get old header from buffer
-        def get_header(buf, off=0):
-            if len(buf) < off + ctypes.sizeof(CacheHeader):
-                return None
-            header = _from_buffer(CacheHeader, buf, off)
-            if header.magic != CACHE_MAGIC:
-                return None
-            return header
-
-        # Get new header from buffer
-        def get_header_new(buf, off=0):
-            if len(buf) < off + ctypes.sizeof(CacheHeaderNew):
-                return None
-            header_new = _from_buffer(CacheHeaderNew, buf, off)
-            if header_new.magic != CACHE_MAGIC_NEW:
-                return None
-            if header_new.version != CACHE_VERSION:
-                return None
-            return header_new
-
-        # Get a string from the buffer (they are null-terminated)
-        def get_string(off):
-            end = buf.find(b'\0', strtable_start + off)
-            if end == -1:
-                return ""
-            return buf[strtable_start+off:end].decode("UTF-8")
+        buf[size_old + size_new:] = strtable
+        return buf
 
+    def _print_cache(self, reader):
         def print_entry(soname, flags, osversion, hwcap, filepath):
             flags_type = _FLAGS_TYPE.get(flags & FLAG_TYPE_MASK, "unknown")
             flags_required = _FLAGS_REQUIRED.get(flags & FLAG_REQUIRED_MASK,
@@ -397,49 +614,15 @@ class Context(object):
                     soname, flags_type, flags_required,
                     hwcap_str, osversion_str, filepath))
 
-        # Is it new format without the old one ?
-        header_new = get_header_new(buf)
-        if header_new is not None:
-            fmt = FORMAT_NEW
-            entries_new = _from_buffer(CacheEntryNew * header_new.nlibs,
-                    buf, ctypes.sizeof(CacheHeaderNew))
-            strtable_start = 0
-        else:
-            # Is it old format ?
-            header = get_header(buf)
-            if header is not None:
-                fmt = FORMAT_OLD
-                entries = _from_buffer(CacheEntry * header.nlibs,
-                        buf, ctypes.sizeof(CacheHeader))
-                off = ctypes.sizeof(CacheHeader) + \
-                        header.nlibs * ctypes.sizeof(CacheEntry)
-                strtable_start = off
-
-                # Check for a new cache embedded in the old format
-                header_new = get_header_new(buf, off)
-                if header_new is not None:
-                    fmt = FORMAT_NEW
-                    entries_new = _from_buffer(CacheEntryNew * header_new.nlibs,
-                            buf, off + ctypes.sizeof(CacheHeaderNew))
-            else:
-                logging.error("'%s' is not a valid cache file",
-                        self.cache_filepath)
-                return
+        if reader.fmt is None:
+            logging.error("'%s' is not a valid cache file",
+                    self.cache_filepath)
+            return
 
-        if fmt == FORMAT_OLD:
-            print("%d libs found in cache `%s'" % (
-                    header.nlibs, self.cache_filepath))
-            for entry in entries:
-                print_entry(get_string(entry.key),
-                        entry.flags, 0, 0,
-                        get_string(entry.value))
-        elif fmt == FORMAT_NEW:
-            print("%d libs found in cache `%s'" % (
-                    header_new.nlibs, self.cache_filepath))
-            for entry_new in entries_new:
-                print_entry(get_string(entry_new.key),
-                        entry_new.flags, entry_new.osversion, entry_new.hwcap,
-                        get_string(entry_new.value))
+        print("%d libs found in cache `%s'" % (
+                len(reader.entries), self.cache_filepath))
+        for entry in reader.entries:
+            print_entry(*entry)
 
     def _get_abs_path(self, path):
         if self.options.root_dirpath:
@@ -489,22 +672,44 @@ class Context(object):
         for filepath in sorted(glob.glob(self._get_abs_path(pattern))):
             self._parse_conf(filepath)
 
-    def _search_dir(self, libdir):
+    # Get the candidate files and hwcap sub-directories of a directory.
+    # Returns a manifest entry whose 'libs' will be filled by _search_dir.
+    def _scan_dir(self, libdir):
         dirpath = self._get_abs_path(libdir)
-        hwcap = self._get_hwcap(libdir)
-
         logging.info("Searching directory '%s'", dirpath)
-        entries = {}
-        for entry in sorted(os.listdir(dirpath)):
-            if os.path.isdir(os.path.join(dirpath, entry)):
-                if self._is_hwcap_platform(entry):
-                    self._add_libdir(os.path.join(libdir, entry))
-            elif os.path.isfile(os.path.join(dirpath, entry)):
-                if (entry.startswith("lib") or entry.startswith("ld-")) and \
-                        ".so" in entry:
-                    self._process_file(entries, libdir, entry)
-        for soname in sorted(entries.keys()):
-            filename, _, flags, osversion = entries[soname]
+        dirinfo = {
+            "stat": _get_dir_stat(dirpath),
+            "files": {},
+            "links": {},
+            "subdirs": [],
+            "libs": None,
+        }
+        for entry in sorted(os.scandir(dirpath), key=lambda e: e.name):
+            if entry.is_dir():
+                if self._is_hwcap_platform(entry.name):
+                    subdir = os.path.join(libdir, entry.name)
+                    dirinfo["subdirs"].append(subdir)
+                    self._add_libdir(subdir)
+            elif (entry.name.startswith("lib") or entry.name.startswith("ld-")) \
+                    and ".so" in entry.name:
+                # Links are also recorded by their own stat, even dangling
+                if entry.is_symlink():
+                    dirinfo["links"][entry.name] = _get_link_stat(entry.path)
+                if entry.is_file():
+                    dirinfo["files"][entry.name] = _get_file_stat(entry.path)
+        return dirinfo
+
+    def _search_dir(self, libdir, dirinfo):
+        hwcap = self._get_hwcap(libdir)
+        if dirinfo["libs"] is None:
+            entries = {}
+            for filename in dirinfo["files"]:
+                self._process_file(entries, libdir, filename)
+            dirinfo["libs"] = []
+            for soname in sorted(entries.keys()):
+                filename, _, flags, osversion = entries[soname]
+                dirinfo["libs"].append([filename, soname, flags, osversion])
+        for (filename, soname, flags, osversion) in dirinfo["libs"]:
             lib = Library(libdir, filename, soname, flags, osversion, hwcap)
             self._add_lib(lib)
 
@@ -524,20 +729,23 @@ class Context(object):
         filepath = self._get_abs_path(os.path.join(libdir, filename))
         logging.debug("Processing file '%s'", filepath)
 
-        # Load as elf
-        elf = libelf.Elf()
+        # Get elf information
         try:
-            elf.loadFromFile(filepath)
+            info = self.elf_cache.getInfo(filepath)
+            if info is None:
+                raise libelf.ElfError("Bad magic in Ehdr")
         except libelf.ElfError as ex:
             # Not an elf, log unless it is a linker script
             if not Context._is_linker_script(filepath):
                 logging.error("'%s': %s", filepath, str(ex))
             return
-        if elf.ehdr.e_type != libelf.ET_DYN:
+        except OSError as ex:
+            logging.error("Failed to open file: '%s': %s", filepath, str(ex))
+            return
+        if info.e_type != libelf.ET_DYN:
             return
 
-        soname, flags, osversion = Context._process_file_elf(filepath, elf)
-        elf.close()
+        soname, flags, osversion = Context._process_file_elf(filepath, info)
 
         islink = os.path.islink(filepath)
         if islink:
@@ -557,72 +765,51 @@ class Context(object):
                         filename, old_filename, self._get_abs_path(libdir))
             elif (not islink and old_islink) or \
                     (islink != old_islink and \
-                     Context.libcmp(filename, old_filename) > 0):
+                     Context.libcmp_key(filename) > \
+                     Context.libcmp_key(old_filename)):
                 entries[soname] = (filename, islink, flags, osversion)
         else:
             entries[soname] = (filename, islink, flags, osversion)
 
     @staticmethod
-    def _process_file_elf(filepath, elf):
+    def _process_file_elf(filepath, info):
         # Extract SONAME and osversion
-        soname = Context._elf_extract_soname(elf) or os.path.basename(filepath)
-        osversion = Context._elf_extract_osversion(elf)
+        soname = info.soname or os.path.basename(filepath)
+        osversion = info.osversion
 
         # Extract flags
         flags = FLAG_ELF
-        if elf.ehdr.e_machine == libelf.EM_386:
+        if info.e_machine == libelf.EM_386:
             if soname == "ld-linux.so.2":
                 flags = FLAG_ELF
             else:
-                flags = Context._process_file_elf_i386(elf)
-        elif elf.ehdr.e_machine == libelf.EM_ARM:
-            flags = Context._process_file_elf_arm(elf)
-        elif elf.ehdr.e_machine == libelf.EM_X86_64:
-            flags = Context._process_file_elf_x86_64(elf)
-        elif elf.ehdr.e_machine == libelf.EM_AARCH64:
-            flags = Context._process_file_elf_aarch64(elf)
+                flags = Context._process_file_elf_i386(info)
+        elif info.e_machine == libelf.EM_ARM:
+            flags = Context._process_file_elf_arm(info)
+        elif info.e_machine == libelf.EM_X86_64:
+            flags = Context._process_file_elf_x86_64(info)
+        elif info.e_machine == libelf.EM_AARCH64:
+            flags = Context._process_file_elf_aarch64(info)
         else:
             logging.warning("Unsupported machine architecture %d for '%s",
-                    elf.ehdr.e_machine, filepath)
+                    info.e_machine, filepath)
 
         return (soname, flags, osversion)
 
     @staticmethod
-    def _elf_extract_soname(elf):
-        for entry in elf.dynamicEntries:
-            if entry.d_tag == libelf.DT_SONAME:
-                return entry.valstr
-        return None
-
-    @staticmethod
-    def _elf_extract_osversion(elf):
-        for shdr in elf.shdrTable:
-            if shdr.sh_type == libelf.SHT_NOTE and \
-                    shdr.namestr == ".note.ABI-tag":
-                data = elf.getSectionData(shdr)
-                if len(data) >= 32:
-                    fmt = elf.ehdr.getFmtPrefix() + "IIIIIIII"
-                    words = struct.unpack(fmt, data[0:32])
-                    if words[0] == 4 and words[1] == 16 and \
-                            words[2] == 1 and words[3] == 0x554e47:
-                        return (words[4] << 24) | (words[5] << 16) | \
-                                (words[6] << 8) | words[7]
-        return 0
-
-    @staticmethod
-    def _process_file_elf_i386(elf):
-        if elf.ehdr.is32Bit():
+    def _process_file_elf_i386(info):
+        if info.is32Bit():
             return FLAG_ELF_LIBC6
         else:
             return FLAG_ELF
 
     @staticmethod
-    def _process_file_elf_arm(elf):
-        eabi = elf.ehdr.e_flags & libelf.EF_ARM_EABIMASK
+    def _process_file_elf_arm(info):
+        eabi = info.e_flags & libelf.EF_ARM_EABIMASK
         if eabi == libelf.EF_ARM_EABI_VER5:
-            if (elf.ehdr.e_flags & libelf.EF_ARM_ABI_FLOAT_HARD) != 0:
+            if (info.e_flags & libelf.EF_ARM_ABI_FLOAT_HARD) != 0:
                 return FLAG_ARM_LIBHF | FLAG_ELF_LIBC6
-            elif (elf.ehdr.e_flags & libelf.EF_ARM_ABI_FLOAT_SOFT) != 0:
+            elif (info.e_flags & libelf.EF_ARM_ABI_FLOAT_SOFT) != 0:
                 return FLAG_ARM_LIBSF | FLAG_ELF_LIBC6
             else:
                 return FLAG_ELF_LIBC6
@@ -630,17 +817,17 @@ class Context(object):
             return FLAG_ELF
 
     @staticmethod
-    def _process_file_elf_x86_64(elf):
-        if elf.ehdr.is64Bit():
+    def _process_file_elf_x86_64(info):
+        if info.is64Bit():
             return FLAG_X8664_LIB64 | FLAG_ELF_LIBC6
-        elif elf.ehdr.is32Bit():
+        elif info.is32Bit():
             return FLAG_X8664_LIBX32 | FLAG_ELF_LIBC6
         else:
             return FLAG_ELF
 
     @staticmethod
-    def _process_file_elf_aarch64(elf):
-        if elf.ehdr.is64Bit():
+    def _process_file_elf_aarch64(info):
+        if info.is64Bit():
             return FLAG_AARCH64_LIB64 | FLAG_ELF_LIBC6
         else:
             return FLAG_ELF
@@ -654,6 +841,20 @@ class Context(object):
                 "INPUT" in contents or \
                 "GNU ld script" in contents
 
+    # Get a key giving the same order as libcmp.
+    # The name is split in alternate runs of text and numbers. A text run
+    # followed by a number gets a terminator greater than any character
+    # because a digit is greater than any other character for libcmp.
+    @staticmethod
+    def libcmp_key(path):
+        runs = _LIBCMP_SPLIT_RE.split(path)
+        key = []
+        for idx in range(0, len(runs) - 1, 2):
+            key.append(runs[idx] + _LIBCMP_DIGIT_MARK)
+            key.append(int(runs[idx + 1]))
+        key.append(runs[-1])
+        return tuple(key)
+
     @staticmethod
     def libcmp(path1, path2):
         class CIter(object):
@@ -688,9 +889,9 @@ class Context(object):
                     val1 = iter1.next() - ord('0')
                     val2 = iter2.next() - ord('0')
                     while isdigit(iter1.peek()):
-                        val1 = val1 * 10 + iter1.next()
+                        val1 = val1 * 10 + iter1.next() - ord('0')
                     while isdigit(iter2.peek()):
-                        val2 = val2 * 10 + iter2.next()
+                        val2 = val2 * 10 + iter2.next() - ord('0')
                     if val1 != val2:
                         return val1 - val2
                 else:
@@ -705,6 +906,74 @@ class Context(object):
                 char1 = iter1.next()
                 char2 = iter2.next()
 
+#===============================================================================
+# Lookup of libraries in an existing cache.
+#
+# Entries are indexed by the Context.libcmp_key of their SONAME so a binary
+# search finds them. Entries of a SONAME are kept in the order of the cache
+# (decreasing priority) that is the order the loader tries them.
+#===============================================================================
+class CacheReader(object):
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.fmt = None
+        self.entries = []
+        self._index = []
+        self._keys = []
+
+        # Open read-only and map copy-on-write so we can use ctypes.from_buffer
+        # that requires writable buffer even if we will only read from it
+        with open(filepath, "rb") as fin:
+            if os.fstat(fin.fileno()).st_size == 0:
+                return
+            buf = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_COPY)
+            try:
+                fmt, entries = _read_cache(buf)
+            finally:
+                buf.close()
+        if fmt is None:
+            return
+        self.fmt = fmt
+        self.entries = entries
+
+        # The sort is stable so the priority between entries of a SONAME
+        # is kept
+        self._index = sorted(entries,
+                key=lambda entry: Context.libcmp_key(entry[0]))
+        self._keys = [Context.libcmp_key(entry[0]) for entry in self._index]
+
+    # Get all entries (soname, flags, osversion, hwcap, filepath) for a SONAME
+    # by decreasing priority.
+    def lookup_entries(self, soname):
+        key = Context.libcmp_key(soname)
+        low = bisect.bisect_left(self._keys, key)
+        high = bisect.bisect_right(self._keys, key, low)
+        return self._index[low:high]
+
+    # Get the path of the library the loader would use for a SONAME.
+    # flags: required flags (None to accept any).
+    # hwcap: hwcap bits supported by the target, entries requiring others
+    #        are skipped.
+    # osversion: version of the target os (None to accept any).
+    # Returns None if not found.
+    def lookup(self, soname, flags=None, hwcap=0, osversion=None):
+        for entry in self.lookup_entries(soname):
+            (_, entry_flags, entry_osversion, entry_hwcap, filepath) = entry
+            if flags is not None and entry_flags != flags:
+                continue
+            if (entry_hwcap & ~hwcap) != 0:
+                continue
+            if osversion is not None and entry_osversion > osversion:
+                continue
+            return filepath
+        return None
+
+    # Lookup a list of SONAME, returns a dictionary SONAME -> path (None
+    # if not found).
+    def lookup_many(self, sonames, flags=None, hwcap=0, osversion=None):
+        return {soname: self.lookup(soname, flags, hwcap, osversion)
+                for soname in sonames}
+
 #===============================================================================
 #===============================================================================
 def main():
@@ -716,6 +985,13 @@ def main():
             logging.warning("Creation of missing links not implemented")
         ctx.build_cache()
         ctx.save_cache()
+        ctx.save_manifest()
+        ctx.elf_cache.save()
+        ctx.stats.endPhase("save")
+        ctx.stats.addAction("elf-cache-misses", count=ctx.elf_cache.misses)
+        ctx.stats.addAction("elf-cache-hits", count=ctx.elf_cache.hits)
+        ctx.stats.addProcess(ctx.elf_cache.processes)
+        ctx.stats.save()
     if options.print_cache:
         ctx.print_cache()
 
@@ -743,6 +1019,33 @@ def parse_args():
         default=LD_SO_CONF,
         help="Use conf instead of %s." % LD_SO_CONF)
 
+    parser.add_argument("--elf-cache",
+        metavar="FILE",
+        dest="elf_cache",
+        default=None,
+        help="File where to cache information extracted from elf files.")
+
+    parser.add_argument("-j", "--jobs",
+        metavar="N",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="Number of processes used to parse libraries.")
+
+    parser.add_argument("--stats",
+        metavar="FILE",
+        dest="stats",
+        default=None,
+        help="File where to save statistics (time per phase, scanned "
+            "directories, parsed files) in json format.")
+
+    parser.add_argument("--manifest",
+        metavar="FILE",
+        dest="manifest",
+        default=None,
+        help="File where to save the state of scanned directories so only "
+            "modified ones are scanned again by the next run.")
+
     parser.add_argument("-N",
         dest="build_cache",
         action="store_false",
@@ -395,6 +395,18 @@ EF_ARM_EABI_VER5 =  0x05000000
 class ElfError(Exception):
     pass
 
+#===============================================================================
+# Cache of compiled struct formats, records of a same table share the same one.
+#===============================================================================
+_structCache = {}
+
+def _getStruct(fmt):
+    st = _structCache.get(fmt, None)
+    if st is None:
+        st = struct.Struct(fmt)
+        _structCache[fmt] = st
+    return st
+
 #===============================================================================
 # The ELF file header. This appears at the start of every ELF file.
 #===============================================================================
@@ -403,7 +415,7 @@ class ElfEhdr(object):
     size64 = 64
     def __init__(self, buf):
         # Read e_ident first so we can get information
-        self.e_ident = struct.unpack("%dB" % EI_NIDENT, buf[0:EI_NIDENT])
+        self.e_ident = _getStruct("%dB" % EI_NIDENT).unpack_from(buf, 0)
         if self.e_ident[EI_MAG0] != ELFMAG0 \
                 or self.e_ident[EI_MAG1] != ELFMAG1 \
                 or self.e_ident[EI_MAG2] != ELFMAG2 \
@@ -425,7 +437,7 @@ class ElfEhdr(object):
             raise ElfError("Bad class in Ehdr")
 
         # Save fields (same order for 32-bit/64-bit)
-        fields = struct.unpack(fmt, buf[EI_NIDENT:self.size])
+        fields = _getStruct(fmt).unpack_from(buf, EI_NIDENT)
         self.e_type = fields[0]       # Object file type
         self.e_machine = fields[1]    # Architecture
         self.e_version = fields[2]    # Object file version
@@ -462,37 +474,46 @@ class ElfEhdr(object):
                 self.e_phentsize, self.e_phnum, self.e_shentsize,
                 self.e_shnum, self.e_shstrndx)
 
+#===============================================================================
+# Get the compiled struct to decode records of the given class (ElfShdr,
+# ElfPhdr, ElfSym, ElfDyn), depending on class and encoding of the file.
+#===============================================================================
+def _getRecordStruct(cls, ehdr):
+    if ehdr.is32Bit():
+        return _getStruct(ehdr.getFmtPrefix() + cls.fmt32)
+    else:
+        return _getStruct(ehdr.getFmtPrefix() + cls.fmt64)
+
 #===============================================================================
 # Section header.
 #===============================================================================
 class ElfShdr(object):
+    __slots__ = ["idx", "namestr", "size",
+            "sh_name", "sh_type", "sh_flags", "sh_addr", "sh_offset",
+            "sh_size", "sh_link", "sh_info", "sh_addralign", "sh_entsize"]
     size32 = 40
     size64 = 64
-    def __init__(self, elf, idx, buf):
+    fmt32 = "IIIIIIIIII"
+    fmt64 = "IIQQQQIIQQ"
+    def __init__(self, elf, idx, buf, offset=0, st=None):
         self.idx = idx
         self.namestr = None
-
-        # Setup format
-        if elf.ehdr.is32Bit():
-            fmt = elf.ehdr.getFmtPrefix() + "IIIIIIIIII"
-            self.size = ElfPhdr.size32
-        else:
-            fmt = elf.ehdr.getFmtPrefix() + "IIQQQQIIQQ"
-            self.size = ElfPhdr.size64
+        if st is None:
+            st = _getRecordStruct(ElfShdr, elf.ehdr)
+        self.size = st.size
 
         # Save fields (same order for 32-bit/64-bit)
-        fields = struct.unpack(fmt, buf)
-
-        self.sh_name = fields[0]      # Section name (string tbl index)
-        self.sh_type = fields[1]      # Section type
-        self.sh_flags = fields[2]     # Section flags
-        self.sh_addr = fields[3]      # Section virtual addr at execution
-        self.sh_offset = fields[4]    # Section file offset
-        self.sh_size = fields[5]      # Section size in bytes
-        self.sh_link = fields[6]      # Link to another section
-        self.sh_info = fields[7]      # Additional section information
-        self.sh_addralign = fields[8] # Section alignment
-        self.sh_entsize = fields[9]   # Entry size if section holds table
+        fields = st.unpack_from(buf, offset)
+        self.sh_name = fields[0]       # Section name (string tbl index)
+        self.sh_type = fields[1]       # Section type
+        self.sh_flags = fields[2]      # Section flags
+        self.sh_addr = fields[3]       # Section virtual addr at execution
+        self.sh_offset = fields[4]     # Section file offset
+        self.sh_size = fields[5]       # Section size in bytes
+        self.sh_link = fields[6]       # Link to another section
+        self.sh_info = fields[7]       # Additional section information
+        self.sh_addralign = fields[8]  # Section alignment
+        self.sh_entsize = fields[9]    # Entry size if section holds table
 
     def __str__(self):
         return \
@@ -507,39 +528,39 @@ class ElfShdr(object):
 # Program segment header.
 #===============================================================================
 class ElfPhdr(object):
+    __slots__ = ["idx", "size",
+            "p_type", "p_offset", "p_vaddr", "p_paddr",
+            "p_filesz", "p_memsz", "p_flags", "p_align"]
     size32 = 32
     size64 = 56
-    def __init__(self, elf, idx, buf):
+    fmt32 = "IIIIIIII"
+    fmt64 = "IIQQQQQQ"
+    def __init__(self, elf, idx, buf, offset=0, st=None):
         self.idx = idx
-
-        # Setup format
-        if elf.ehdr.is32Bit():
-            fmt = elf.ehdr.getFmtPrefix() + "IIIIIIII"
-            self.size = ElfPhdr.size32
-        else:
-            fmt = elf.ehdr.getFmtPrefix() + "IIQQQQQQ"
-            self.size = ElfPhdr.size64
+        if st is None:
+            st = _getRecordStruct(ElfPhdr, elf.ehdr)
+        self.size = st.size
 
         # Save fields (order depends on 32-bit/64-bit)
-        fields = struct.unpack(fmt, buf)
-        if elf.ehdr.is32Bit():
-            self.p_type = fields[0]   # Segment type
-            self.p_offset = fields[1] # Segment file offset
-            self.p_vaddr = fields[2]  # Segment virtual address
-            self.p_paddr = fields[3]  # Segment physical address
-            self.p_filesz = fields[4] # Segment size in file
-            self.p_memsz = fields[5]  # Segment size in memory
-            self.p_flags = fields[6]  # Segment flags
-            self.p_align = fields[7]  # Segment alignment
+        fields = st.unpack_from(buf, offset)
+        if self.size == ElfPhdr.size32:
+            self.p_type = fields[0]    # Segment type
+            self.p_offset = fields[1]  # Segment file offset
+            self.p_vaddr = fields[2]   # Segment virtual address
+            self.p_paddr = fields[3]   # Segment physical address
+            self.p_filesz = fields[4]  # Segment size in file
+            self.p_memsz = fields[5]   # Segment size in memory
+            self.p_flags = fields[6]   # Segment flags
+            self.p_align = fields[7]   # Segment alignment
         else:
-            self.p_type = fields[0]   # Segment type
-            self.p_flags = fields[1]  # Segment flags
-            self.p_offset = fields[2] # Segment file offset
-            self.p_vaddr = fields[3]  # Segment virtual address
-            self.p_paddr = fields[4]  # Segment physical address
-            self.p_filesz = fields[5] # Segment size in file
-            self.p_memsz = fields[6]  # Segment size in memory
-            self.p_align = fields[7]  # Segment alignment
+            self.p_type = fields[0]    # Segment type
+            self.p_flags = fields[1]   # Segment flags
+            self.p_offset = fields[2]  # Segment file offset
+            self.p_vaddr = fields[3]   # Segment virtual address
+            self.p_paddr = fields[4]   # Segment physical address
+            self.p_filesz = fields[5]  # Segment size in file
+            self.p_memsz = fields[6]   # Segment size in memory
+            self.p_align = fields[7]   # Segment alignment
 
     def __str__(self):
         return \
@@ -551,36 +572,36 @@ class ElfPhdr(object):
 #===============================================================================
 #===============================================================================
 class ElfSym(object):
+    __slots__ = ["idx", "namestr", "size",
+            "st_name", "st_value", "st_size", "st_info", "st_other",
+            "st_shndx", "st_type", "st_bind", "st_visibility"]
     size32 = 16
     size64 = 24
-    def __init__(self, elf, idx, buf):
+    fmt32 = "IIIBBH"
+    fmt64 = "IBBHQQ"
+    def __init__(self, elf, idx, buf, offset=0, st=None):
         self.idx = idx
         self.namestr = None
-
-        # Setup format
-        if elf.ehdr.is32Bit():
-            fmt = elf.ehdr.getFmtPrefix() + "IIIBBH"
-            self.size = ElfSym.size32
-        else:
-            fmt = elf.ehdr.getFmtPrefix() + "IBBHQQ"
-            self.size = ElfSym.size64
+        if st is None:
+            st = _getRecordStruct(ElfSym, elf.ehdr)
+        self.size = st.size
 
         # Save fields (order depends on 32-bit/64-bit)
-        fields = struct.unpack(fmt, buf)
-        if elf.ehdr.is32Bit():
-            self.st_name = fields[0]  # Symbol name (string tbl index)
-            self.st_value = fields[1] # Symbol value
-            self.st_size = fields[2]  # Symbol size
-            self.st_info = fields[3]  # Symbol type and binding
-            self.st_other = fields[4] # Symbol visibility
-            self.st_shndx = fields[5] # Section index
+        fields = st.unpack_from(buf, offset)
+        if self.size == ElfSym.size32:
+            self.st_name = fields[0]   # Symbol name (string tbl index)
+            self.st_value = fields[1]  # Symbol value
+            self.st_size = fields[2]   # Symbol size
+            self.st_info = fields[3]   # Symbol type and binding
+            self.st_other = fields[4]  # Symbol visibility
+            self.st_shndx = fields[5]  # Section index
         else:
-            self.st_name = fields[0]  # Symbol name (string tbl index)
-            self.st_info = fields[1]  # Symbol type and binding
-            self.st_other = fields[2] # Symbol visibility
-            self.st_shndx = fields[3] # Section index
-            self.st_value = fields[4] # Symbol value
-            self.st_size = fields[5]  # Symbol size
+            self.st_name = fields[0]   # Symbol name (string tbl index)
+            self.st_info = fields[1]   # Symbol type and binding
+            self.st_other = fields[2]  # Symbol visibility
+            self.st_shndx = fields[3]  # Section index
+            self.st_value = fields[4]  # Symbol value
+            self.st_size = fields[5]   # Symbol size
         self.st_type = self.st_info&0xf
         self.st_bind = (self.st_info>>4)&0xf
         self.st_visibility = self.st_other&0x3
@@ -595,23 +616,21 @@ class ElfSym(object):
 #===============================================================================
 #===============================================================================
 class ElfDyn(object):
+    __slots__ = ["idx", "valstr", "size", "d_tag", "d_val"]
     size32 = 8
     size64 = 16
-    strTags = [DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH]
-    def __init__(self, elf, idx, buf):
+    fmt32 = "II"
+    fmt64 = "QQ"
+    strTags = frozenset([DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH])
+    def __init__(self, elf, idx, buf, offset=0, st=None):
         self.idx = idx
         self.valstr = None
-
-        # Setup format
-        if elf.ehdr.is32Bit():
-            fmt = elf.ehdr.getFmtPrefix() + "II"
-            self.size = ElfDyn.size32
-        else:
-            fmt = elf.ehdr.getFmtPrefix() + "QQ"
-            self.size = ElfDyn.size64
+        if st is None:
+            st = _getRecordStruct(ElfDyn, elf.ehdr)
+        self.size = st.size
 
         # Save fields
-        fields = struct.unpack(fmt, buf)
+        fields = st.unpack_from(buf, offset)
         self.d_tag = fields[0]
         self.d_val = fields[1]
 
@@ -630,18 +649,20 @@ class Elf(object):
         self.ehdr = None
         self.phdrTable = []
         self.shdrTable = []
-        self.symTable = []
-        self.dynsymTable = []
-        self.dynamicEntries = []
+        self._symTable = None
+        self._dynsymTable = None
+        self._dynamicEntries = None
         self._data = None
 
-    def loadFromFile(self, filePath):
+    # If lazy is True, only headers are read at load time, symbol tables and
+    # dynamic entries are read on first access (so before calling close).
+    def loadFromFile(self, filePath, lazy=False):
         elfFile = None
         try:
             # Open file, map it in memory and start reading it
             elfFile = open(filePath, "rb")
             self._data = mmap.mmap(elfFile.fileno(), 0, access=mmap.ACCESS_READ)
-            self._read()
+            self._read(lazy)
         except struct.error as ex:
             raise ElfError(str(ex))
         finally:
@@ -654,55 +675,90 @@ class Elf(object):
             self._data.close()
             self._data = None
 
-    def _read(self):
+    @property
+    def symTable(self):
+        if self._symTable is None:
+            self._symTable = self._readSymTables(SHT_SYMTAB)
+        return self._symTable
+
+    @property
+    def dynsymTable(self):
+        if self._dynsymTable is None:
+            self._dynsymTable = self._readSymTables(SHT_DYNSYM)
+        return self._dynsymTable
+
+    @property
+    def dynamicEntries(self):
+        if self._dynamicEntries is None:
+            self._dynamicEntries = []
+            for shdr in self.shdrTable:
+                if shdr.sh_type == SHT_DYNAMIC:
+                    self._readDynamicSection(shdr, self._dynamicEntries)
+        return self._dynamicEntries
+
+    def _read(self, lazy):
         self._readEhdr()
         self._readPhdrTable()
         self._readShdrTable()
         for shdr in self.shdrTable:
             shdr.namestr = self._getString(self.ehdr.e_shstrndx, shdr.sh_name)
-            if shdr.sh_type == SHT_SYMTAB:
-                self._readSymTable(shdr, self.symTable)
-            elif shdr.sh_type == SHT_DYNSYM:
-                self._readSymTable(shdr, self.dynsymTable)
-            elif shdr.sh_type == SHT_DYNAMIC:
-                self._readDynamicSection(shdr)
+        if not lazy:
+            # Force loading of everything
+            _ = self.symTable
+            _ = self.dynsymTable
+            _ = self.dynamicEntries
+
+    def _checkLoaded(self):
+        if self._data is None:
+            raise ElfError("Elf file not loaded or already closed")
 
     def _readEhdr(self):
         # Give all data, we don't known yet which size to give
         self.ehdr = ElfEhdr(self._data)
 
     def _readPhdrTable(self):
-        size = ElfPhdr.size32 if self.ehdr.is32Bit() else ElfPhdr.size64
+        st = _getRecordStruct(ElfPhdr, self.ehdr)
         for i in range(0, self.ehdr.e_phnum):
             offset = self.ehdr.e_phoff + i*self.ehdr.e_phentsize
-            phdr = ElfPhdr(self, i, self._data[offset:offset+size])
-            self.phdrTable.append(phdr)
+            self.phdrTable.append(ElfPhdr(self, i, self._data, offset, st))
 
     def _readShdrTable(self):
-        size = ElfShdr.size32 if self.ehdr.is32Bit() else ElfShdr.size64
+        st = _getRecordStruct(ElfShdr, self.ehdr)
         for i in range(0, self.ehdr.e_shnum):
             offset = self.ehdr.e_shoff + i*self.ehdr.e_shentsize
-            shdr = ElfShdr(self, i, self._data[offset:offset+size])
-            self.shdrTable.append(shdr)
+            self.shdrTable.append(ElfShdr(self, i, self._data, offset, st))
+
+    def _readSymTables(self, shType):
+        self._checkLoaded()
+        table = []
+        for shdr in self.shdrTable:
+            if shdr.sh_type == shType:
+                try:
+                    self._readSymTable(shdr, table)
+                except struct.error as ex:
+                    raise ElfError(str(ex))
+        return table
 
     def _readSymTable(self, shdr, table):
-        size = ElfSym.size32 if self.ehdr.is32Bit() else ElfSym.size64
-        for i in range(0, shdr.sh_size//size):
-            offset = shdr.sh_offset + i*size
-            sym = ElfSym(self, i, self._data[offset:offset+size])
+        st = _getRecordStruct(ElfSym, self.ehdr)
+        for i in range(0, shdr.sh_size//st.size):
+            sym = ElfSym(self, i, self._data, shdr.sh_offset + i*st.size, st)
             sym.namestr = self._getString(shdr.sh_link, sym.st_name)
             table.append(sym)
 
-    def _readDynamicSection(self, shdr):
-        size = ElfDyn.size32 if self.ehdr.is32Bit() else ElfDyn.size64
-        for i in range(0, shdr.sh_size//size):
-            offset = shdr.sh_offset + i*size
-            dyn = ElfDyn(self, i, self._data[offset:offset+size])
-            if dyn.d_tag in ElfDyn.strTags:
-                dyn.valstr = self._getString(shdr.sh_link, dyn.d_val)
-            self.dynamicEntries.append(dyn)
-            if dyn.d_tag == DT_NULL:
-                break
+    def _readDynamicSection(self, shdr, entries):
+        self._checkLoaded()
+        st = _getRecordStruct(ElfDyn, self.ehdr)
+        try:
+            for i in range(0, shdr.sh_size//st.size):
+                dyn = ElfDyn(self, i, self._data, shdr.sh_offset + i*st.size, st)
+                if dyn.d_tag in ElfDyn.strTags:
+                    dyn.valstr = self._getString(shdr.sh_link, dyn.d_val)
+                entries.append(dyn)
+                if dyn.d_tag == DT_NULL:
+                    break
+        except struct.error as ex:
+            raise ElfError(str(ex))
 
     def _getString(self, idx, offset):
         if idx >= len(self.shdrTable):
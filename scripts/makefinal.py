@@ -15,8 +15,20 @@ import sys, os, logging
 import stat
 import subprocess
 import argparse
+import fcntl
+import json
 import re
 import fnmatch
+import shlex
+import shutil
+import time
+import concurrent.futures
+
+import libelf
+import elfcache
+import stripcache
+import stats
+import host
 
 #===============================================================================
 # Global variables.
@@ -66,6 +78,21 @@ EXCLUDE_FILTERS = {
 
 EXCLUDE_FILTERS_PYTHON = [".py", ".pyc", ".pyo"]
 
+# How files not stripped are installed
+LINK_MODE_COPY = "copy"
+LINK_MODE_HARDLINK = "hardlink"
+LINK_MODE_REFLINK = "reflink"
+LINK_MODES = [LINK_MODE_COPY, LINK_MODE_HARDLINK, LINK_MODE_REFLINK]
+
+# ioctl to share the data of a file with another one (see linux/fs.h)
+FICLONE = 0x40049409
+
+# Size of the buffer used to write the list of installed files
+FILELIST_BUFFER_SIZE = 1024 * 1024
+
+# Increment when the content of the manifest changes
+MANIFEST_VERSION = 2
+
 # Linux folders/links
 LINUX_BASIC_SKEL = [
     ["dev", None],
@@ -149,6 +176,267 @@ class Makefile(object):
             self.fout.write("\n")
         self._writeFooter()
 
+#==============================================================================
+# Copy files with a pool of threads instead of generating a makefile.
+#==============================================================================
+class CopyEngine(object):
+    def __init__(self, jobs):
+        self.jobs = max(1, jobs)
+        self.rules = {}
+
+    def addCopyCmd(self, dstFileName, srcFileName, doStrip):
+        # Overwrite existing
+        if dstFileName in self.rules:
+            logging.debug("Overwrite %s: %s -> %s", dstFileName,
+                    self.rules[dstFileName][1], srcFileName)
+        self.rules[dstFileName] = (dstFileName, srcFileName, doStrip)
+
+    # Returns False if some copies failed.
+    def run(self, options):
+        logging.debug("Copying %d files with %d jobs", len(self.rules), self.jobs)
+        result = True
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            futures = [(dstFileName, executor.submit(doCopyNative,
+                    dstFileName, srcFileName, options, doStrip))
+                    for (dstFileName, srcFileName, doStrip)
+                    in self.rules.values()]
+            for (dstFileName, future) in futures:
+                if not future.result():
+                    result = False
+                    if options.syncManifest is not None:
+                        options.syncManifest.setFailed(
+                                os.path.relpath(dstFileName, options.finalDir))
+        return result
+
+#==============================================================================
+# Files installed in the final directory by the previous and current runs.
+#
+# In incremental mode, a file is copied only if its entry (source, size, mtime,
+# strip decision, link target, mode) changed since the previous run, and files
+# not installed anymore are removed instead of recreating the whole final tree.
+#==============================================================================
+class SyncManifest(object):
+    def __init__(self, filePath, options):
+        self.filePath = filePath
+        self.finalDir = options.finalDir
+        self.settings = SyncManifest._getSettings(options)
+        # Entries of previous and current run indexed by path relative to
+        # final directory, None for a failed copy
+        self.oldEntries = {}
+        self.entries = {}
+        # Directories created from skeletons, never removed
+        self.dirs = set()
+        # If settings changed, old entries are only used to find stale files
+        self.canSkip = False
+        # Paths installed by the current run that were already up to date
+        self.upToDate = set()
+        # Directories where python files are removed once compiled, they are
+        # not installed again while they are up to date
+        self.removedPyDirs = [os.path.relpath(
+                getRealPath(self.finalDir, removedPyDir), self.finalDir)
+                for removedPyDir in options.removedPyDirs]
+        # Files generated in the final directory after this script by the
+        # previous run, indexed by path with the path of the installed file
+        # they are generated from (None if not generated from a file)
+        self.generatedPath = options.generatedPath
+        self.generated = {}
+        self._load()
+        self._loadGenerated()
+
+    @staticmethod
+    def makeEntry(srcFileName, srcIsLink, doStrip):
+        srcStat = os.lstat(srcFileName)
+        target = os.readlink(srcFileName) if srcIsLink else None
+        return [srcFileName, srcStat.st_size, srcStat.st_mtime_ns,
+                doStrip, target, stat.S_IMODE(srcStat.st_mode)]
+
+    def add(self, relPath, entry):
+        self.entries[relPath] = entry
+
+    def addDir(self, relPath):
+        self.dirs.add(relPath)
+
+    def setFailed(self, relPath):
+        self.entries[relPath] = None
+
+    # Check if a link has already been installed by the current run.
+    def hasLink(self, relPath):
+        entry = self.entries.get(relPath, None)
+        return entry is not None and entry[4] is not None
+
+    # Check if the destination was installed from the same entry by the
+    # previous run and is still there (or was removed once compiled).
+    def isUpToDate(self, relPath, entry, dstFileName):
+        if self.canSkip \
+                and self.oldEntries.get(relPath, None) == entry \
+                and (os.path.lexists(dstFileName) or
+                        self._isRemovedPy(relPath)) \
+                and os.path.islink(dstFileName) == (entry[4] is not None):
+            self.upToDate.add(relPath)
+            return True
+        return False
+
+    def _isRemovedPy(self, relPath):
+        if not relPath.endswith(".py"):
+            return False
+        for removedPyDir in self.removedPyDirs:
+            if relPath.startswith(removedPyDir + "/"):
+                return True
+        return False
+
+    # Remove files generated by the previous run that are not generated from
+    # an installed file, they are generated again from scratch after this
+    # script. All of them are removed if settings changed.
+    # Returns the number of removed files.
+    def removeGenerated(self):
+        count = 0
+        for relPath in sorted(self.generated.keys()):
+            if self.canSkip and self.generated[relPath] is not None:
+                continue
+            count += self._removeGeneratedFile(relPath)
+            del self.generated[relPath]
+        return count
+
+    # Remove files generated by the previous run from an installed file that
+    # is not up to date anymore, they are generated again after this script.
+    # Returns the number of removed files.
+    def removeOutdatedGenerated(self):
+        count = 0
+        for relPath in sorted(self.generated.keys()):
+            if self.generated[relPath] in self.upToDate:
+                continue
+            # Installed by the current run, overwritten when generated again
+            if relPath not in self.entries:
+                count += self._removeGeneratedFile(relPath)
+            del self.generated[relPath]
+        return count
+
+    def _removeGeneratedFile(self, relPath):
+        dstFileName = os.path.join(self.finalDir, relPath)
+        if not os.path.lexists(dstFileName) or \
+                (os.path.isdir(dstFileName) and
+                not os.path.islink(dstFileName)):
+            return 0
+        logging.info("Remove generated : %s", relPath)
+        try:
+            os.unlink(dstFileName)
+            return 1
+        except OSError as ex:
+            logging.warning("Failed to remove '%s': %s", relPath, ex)
+            return 0
+
+    # Remove files installed by the previous run but not by the current one,
+    # and their parent directories if they become empty.
+    # Returns the number of removed files.
+    def removeStale(self):
+        count = 0
+        keptDirs = set(self.dirs)
+        for relPath in self.entries.keys():
+            relDir = os.path.dirname(relPath)
+            while relDir and relDir not in keptDirs:
+                keptDirs.add(relDir)
+                relDir = os.path.dirname(relDir)
+
+        for relPath in sorted(self.oldEntries.keys()):
+            if relPath in self.entries:
+                continue
+            dstFileName = os.path.join(self.finalDir, relPath)
+            # Replaced by a directory
+            if not os.path.lexists(dstFileName) or \
+                    (os.path.isdir(dstFileName) and
+                    not os.path.islink(dstFileName)):
+                continue
+            logging.info("Remove : %s", relPath)
+            try:
+                os.unlink(dstFileName)
+                count += 1
+                relDir = os.path.dirname(relPath)
+                while relDir and relDir not in keptDirs:
+                    os.rmdir(os.path.join(self.finalDir, relDir))
+                    relDir = os.path.dirname(relDir)
+            except OSError as ex:
+                # Most likely a directory not empty
+                logging.debug("Failed to remove '%s': %s", relPath, ex)
+        return count
+
+    def save(self):
+        logging.debug("Saving manifest '%s' (%d entries)",
+                self.filePath, len(self.entries))
+        try:
+            tmpFilePath = "%s.%d.tmp" % (self.filePath, os.getpid())
+            with open(tmpFilePath, "w") as fout:
+                json.dump({
+                    "version": MANIFEST_VERSION,
+                    "finalDir": self.finalDir,
+                    "settings": self.settings,
+                    "entries": self.entries,
+                }, fout)
+            os.rename(tmpFilePath, self.filePath)
+        except IOError as ex:
+            logging.warning("Failed to save manifest: %s [err=%d %s]",
+                    self.filePath, ex.errno, ex.strerror)
+
+        # Files generated by the next steps are appended to this list
+        if self.generatedPath is None:
+            return
+        try:
+            with open(self.generatedPath, "w") as fout:
+                for relPath in sorted(self.generated.keys()):
+                    fout.write("%s\t%s\n" % (relPath, self.generated[relPath]))
+        except IOError as ex:
+            logging.warning("Failed to save generated files: %s [err=%d %s]",
+                    self.generatedPath, ex.errno, ex.strerror)
+
+    def _load(self):
+        try:
+            with open(self.filePath, "r") as fin:
+                data = json.load(fin)
+            if data.get("version", None) != MANIFEST_VERSION or \
+                    data.get("finalDir", None) != self.finalDir:
+                logging.debug("Ignoring manifest '%s': version mismatch",
+                        self.filePath)
+                return
+            self.oldEntries = data["entries"]
+            self.canSkip = (data.get("settings", None) == self.settings)
+            if not self.canSkip:
+                logging.info("Settings changed, all files will be copied")
+        except (IOError, ValueError, KeyError, AttributeError):
+            pass
+
+    # One path per line, optionally followed by a tab and the path of the
+    # installed file it is generated from
+    def _loadGenerated(self):
+        if self.generatedPath is None:
+            return
+        try:
+            with open(self.generatedPath, "r") as fin:
+                for line in fin:
+                    fields = line.rstrip("\n").split("\t", 1)
+                    if not fields[0]:
+                        continue
+                    relPath = os.path.normpath(fields[0])
+                    srcRelPath = os.path.normpath(fields[1]) \
+                            if len(fields) > 1 else None
+                    # keep a file unconditionally generated as it is
+                    if self.generated.get(relPath, srcRelPath) is None:
+                        srcRelPath = None
+                    self.generated[relPath] = srcRelPath
+        except IOError:
+            pass
+
+    # Options changing the content of installed files
+    @staticmethod
+    def _getSettings(options):
+        return {
+            "strip": options.strip,
+            "stripKernel": options.stripKernel,
+            "stripFilters": options.stripFilters,
+            "removeWGO": options.removeWGO,
+            "mode": options.mode,
+            "keepPythonFiles": options.keepPythonFiles,
+            "removedPyDirs": options.removedPyDirs,
+        }
+
 #==============================================================================
 # Execute a command and get its output
 #==============================================================================
@@ -171,17 +459,41 @@ def isExec(filePath):
     return False
 
 #===============================================================================
-# Determine if a file can be stripped.
+# Determine if a file can be stripped (it has symbols).
 # Required under android because soslim crashes when trying to strip
 # static executables compiled with eglibc.
 #===============================================================================
-def canStrip(filePath):
+def canStrip(filePath, options):
+    try:
+        info = options.elfCache.getInfo(filePath)
+    except libelf.ElfError:
+        # assume not strippable if it can not be parsed
+        return False
+    except IOError as ex:
+        logging.error("Failed to open file: %s ([err=%d] %s)",
+            filePath, ex.errno, ex.strerror)
+        return False
+
+    # Not an elf file (PE), ask nm
+    if info is None:
+        return canStripByNm(filePath, options.stats)
+
+    # This is what nm reports as 'no symbols'
+    return info.hasSymTab
+
+#===============================================================================
+# Determine if a file can be stripped with the output of nm.
+#===============================================================================
+def canStripByNm(filePath, stats):
     result = False
     try:
         # get error output from nm command to check for 'no symbols'
-        res = subprocess.run("nm %s" % filePath,
+        startTime = time.monotonic()
+        stats.addProcess()
+        res = subprocess.run(["nm", filePath],
             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
-            shell=True, check=True)
+            check=True)
+        stats.addOperation("nm", filePath, time.monotonic() - startTime)
         res = res.stderr.decode("UTF-8").rstrip("\n").split("\n")
         result = (len(res) == 0 or res[0].find("no symbols") < 0)
     except (IOError, subprocess.CalledProcessError):
@@ -226,20 +538,53 @@ def getRealPath(finalDir, path):
     # First, make it absolute
     if not os.path.isabs(path):
         path = os.path.join(finalDir, path)
-    bits = ["/"] + path.split("/")[1:]
-
-    for i in range(2, len(bits)):
-        component = os.path.join(*bits[0:i])
+    (dirPath, fileName) = os.path.split(path)
+    return os.path.abspath(os.path.join(
+            _getRealDirPath(finalDir, dirPath), fileName))
+
+# Resolved directories (by finalDir and path) of the current run.
+# Only creating a link can change the result, creating a directory can not.
+_realDirPathCache = {}
+
+def _getRealDirPath(finalDir, dirPath):
+    result = _realDirPathCache.get((finalDir, dirPath), None)
+    if result is not None:
+        return result
+
+    (parentPath, name) = os.path.split(dirPath)
+    if parentPath == dirPath:
+        # Root
+        return dirPath
+    realParentPath = _getRealDirPath(finalDir, parentPath)
+    if name == "" or name == ".":
+        result = realParentPath
+    elif name == "..":
+        result = os.path.dirname(realParentPath)
+    else:
+        result = os.path.join(realParentPath, name)
         # Resolve symbolic links.
-        if os.path.islink(component):
-            resolved = resolveLink(finalDir, component)
-            if resolved is None:
-                # Infinite loop -- return original component + rest of the path
-                return os.path.abspath(os.path.join(*([component] + bits[i:])))
-            else:
-                return getRealPath(finalDir, os.path.join(*([resolved] + bits[i:])))
+        if os.path.islink(result):
+            resolved = resolveLink(finalDir, result)
+            if resolved is not None:
+                result = _getRealDirPath(finalDir, resolved)
+            # else: infinite loop -- keep the component as is
+    _realDirPathCache[(finalDir, dirPath)] = result
+    return result
 
-    return os.path.abspath(path)
+#===============================================================================
+# Forget resolved directories after creating a link.
+#===============================================================================
+def invalidateRealPathCache():
+    _realDirPathCache.clear()
+
+#===============================================================================
+# Get the strip program to use for a file.
+#===============================================================================
+def getStripProg(srcFileName, options):
+    if srcFileName.endswith(".ko") and options.stripKernel is not None:
+        return options.stripKernel
+    else:
+        return options.strip
 
 #===============================================================================
 # Get the commands to be executed for the copy.
@@ -247,38 +592,198 @@ def getRealPath(finalDir, path):
 def getCopyCmds(dstFileName, srcFileName, options, doStrip=False):
     cmds = []
     if not doStrip:
-        # Simple copy
-        cmds.append("cp -af \"%s\" \"%s\"" % (srcFileName, dstFileName))
+        # Simple copy (do not write in a link to the strip cache or staging)
+        if options.stripCache is None and options.linkMode == LINK_MODE_COPY:
+            copyCmd = "cp -af \"%s\" \"%s\"" % (srcFileName, dstFileName)
+        elif options.linkMode == LINK_MODE_REFLINK:
+            copyCmd = "cp -af --reflink=auto --remove-destination " \
+                    "\"%s\" \"%s\"" % (srcFileName, dstFileName)
+        else:
+            copyCmd = "cp -af --remove-destination \"%s\" \"%s\"" % (
+                    srcFileName, dstFileName)
+        if canHardLink(srcFileName, options):
+            cmds.append("ln -f \"%s\" \"%s\" 2>/dev/null || %s" % (
+                    srcFileName, dstFileName, copyCmd))
+        else:
+            cmds.append(copyCmd)
     else:
-        if doStrip:
-            if srcFileName.endswith(".ko") and options.stripKernel is not None:
-                cmds.append("%s -o \"%s\" \"%s\"" % \
-                    (options.stripKernel, dstFileName, srcFileName))
-            else:
+        stripProg = getStripProg(srcFileName, options)
+        mode = stat.S_IMODE(os.stat(srcFileName).st_mode)
+        if options.stripCache is None:
+            cmds.append("%s -o \"%s\" \"%s\"" % \
+                (stripProg, dstFileName, srcFileName))
+        else:
+            # Strip in the cache if needed and copy it (never link it, its
+            # mode and timestamp are changed below)
+            cachedFileName = options.stripCache.getPath(srcFileName, stripProg)
+            if not options.stripCache.isCached(cachedFileName):
+                os.makedirs(os.path.dirname(cachedFileName), exist_ok=True)
+                tmpFileName = options.stripCache.getTmpPath(cachedFileName)
                 cmds.append("%s -o \"%s\" \"%s\"" % \
-                    (options.strip, dstFileName, srcFileName))
+                    (stripProg, tmpFileName, srcFileName))
+                cmds.append("mv -f \"%s\" \"%s\"" % \
+                    (tmpFileName, cachedFileName))
+            cmds.append("cp --reflink=auto --remove-destination \"%s\" \"%s\"" % \
+                (cachedFileName, dstFileName))
         # Restore mode and timestamp
-        mode = stat.S_IMODE(os.stat(srcFileName).st_mode)
         cmds.append("chmod 0%o \"%s\"" % (mode, dstFileName))
         cmds.append("touch -r \"%s\" \"%s\"" % (srcFileName, dstFileName))
     if options.removeWGO and not os.path.islink(srcFileName):
         cmds.append("chmod g-w,o-w \"%s\"" % dstFileName)
     return cmds
 
+#===============================================================================
+# Determine if a file not stripped can be installed with a hard link. Only files
+# of the staging directory are linked (skeletons are source files that shall
+# never be modified through the final directory). Its mode shall not be
+# modified as it is shared with the staging directory.
+#===============================================================================
+def canHardLink(srcFileName, options):
+    if options.linkMode != LINK_MODE_HARDLINK:
+        return False
+    if not srcFileName.startswith(options.stagingDir + "/"):
+        return False
+    if options.removeWGO:
+        mode = os.stat(srcFileName).st_mode
+        return (mode & (stat.S_IWGRP | stat.S_IWOTH)) == 0
+    return True
+
+#===============================================================================
+# Hard link a file. Returns False if it is not possible (not on the same file
+# system, not supported...).
+#===============================================================================
+def linkFile(srcFileName, dstFileName):
+    try:
+        os.link(srcFileName, dstFileName)
+        return True
+    except OSError as ex:
+        logging.debug("Failed to link '%s': %s", dstFileName, ex)
+        return False
+
+#===============================================================================
+# Share the data of a file with the file system (btrfs, xfs...). Returns False
+# if it is not possible (not on the same file system, not supported...).
+#===============================================================================
+def cloneFileData(srcFileName, dstFileName):
+    try:
+        with open(srcFileName, "rb") as fin, open(dstFileName, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return True
+    except OSError as ex:
+        logging.debug("Failed to clone '%s': %s", dstFileName, ex)
+        return False
+
 #===============================================================================
 # Copy a file using a makefile (to do strip in parallel).
 #===============================================================================
 def doCopyByMakefile(dstFileName, srcFileName, options, doStrip=False):
     options.makefile.addCopyCmd(dstFileName, srcFileName, doStrip)
 
+#===============================================================================
+# Copy the content of a file, without going through user space if possible.
+#===============================================================================
+def copyFileData(srcFileName, dstFileName):
+    with open(srcFileName, "rb") as fin, open(dstFileName, "wb") as fout:
+        size = os.fstat(fin.fileno()).st_size
+        copied = 0
+
+        # copy_file_range is not always supported (old kernel or python,
+        # cross device...), neither is sendfile
+        try:
+            while copied < size:
+                count = os.copy_file_range(fin.fileno(), fout.fileno(),
+                        size - copied, copied, copied)
+                if count == 0:
+                    break
+                copied += count
+            return
+        except (AttributeError, OSError):
+            pass
+        fout.seek(copied)
+        try:
+            while copied < size:
+                count = os.sendfile(fout.fileno(), fin.fileno(),
+                        copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return
+        except OSError:
+            pass
+        fin.seek(copied)
+        fout.seek(copied)
+        shutil.copyfileobj(fin, fout)
+
+#===============================================================================
+# Copy a file/link without external commands (except strip).
+# Returns False in case of error.
+#===============================================================================
+def doCopyNative(dstFileName, srcFileName, options, doStrip=False):
+    logging.debug("Install: %s", os.path.relpath(dstFileName, options.finalDir))
+    try:
+        srcStat = os.lstat(srcFileName)
+        times = (srcStat.st_atime_ns, srcStat.st_mtime_ns)
+
+        # Never write in an existing file, it can be a hard link to another file
+        if os.path.lexists(dstFileName):
+            os.unlink(dstFileName)
+
+        if stat.S_ISLNK(srcStat.st_mode):
+            os.symlink(os.readlink(srcFileName), dstFileName)
+            invalidateRealPathCache()
+            os.utime(dstFileName, ns=times, follow_symlinks=False)
+            options.stats.addAction("symlink")
+            return True
+
+        mode = stat.S_IMODE(srcStat.st_mode)
+        if options.removeWGO:
+            mode &= ~(stat.S_IWGRP | stat.S_IWOTH)
+
+        if not doStrip:
+            # A hard link already has the mode and timestamp of the source
+            if canHardLink(srcFileName, options) \
+                    and linkFile(srcFileName, dstFileName):
+                options.stats.addAction("hardlink", srcStat.st_size)
+                return True
+            if options.linkMode == LINK_MODE_REFLINK \
+                    and cloneFileData(srcFileName, dstFileName):
+                options.stats.addAction("reflink", srcStat.st_size)
+            else:
+                copyFileData(srcFileName, dstFileName)
+                options.stats.addAction("copy", srcStat.st_size)
+            shutil.copystat(srcFileName, dstFileName)
+        elif options.stripCache is not None:
+            stripProg = getStripProg(srcFileName, options)
+            cachedFileName = options.stripCache.strip(srcFileName,
+                    stripProg, options.stats)
+            if cachedFileName is None:
+                return False
+            stripcache.copyFromCache(cachedFileName, dstFileName)
+        else:
+            # stripProg may already contains some arguments
+            stripProg = getStripProg(srcFileName, options)
+            startTime = time.monotonic()
+            options.stats.addProcess()
+            subprocess.check_call(shlex.split(stripProg) +
+                    ["-o", dstFileName, srcFileName])
+            options.stats.addOperation("strip", srcFileName,
+                    time.monotonic() - startTime)
+            options.stats.addAction("strip", srcStat.st_size)
+
+        # Restore mode and timestamp
+        os.chmod(dstFileName, mode)
+        os.utime(dstFileName, ns=times)
+        return True
+    except (OSError, subprocess.CalledProcessError) as ex:
+        logging.error("Failed to install '%s': %s", dstFileName, ex)
+        return False
+
 #===============================================================================
 # Copy a file by directly making a copy.
+# Returns False in case of error.
 #===============================================================================
 def doCopyDirect(dstFileName, srcFileName, options, doStrip=False):
-    cmds = getCopyCmds(dstFileName, srcFileName, options, doStrip)
-    for cmd in cmds:
-        logging.debug("  %s", cmd)
-        os.system(cmd)
+    return doCopyNative(dstFileName, srcFileName, options, doStrip)
 
 #===============================================================================
 #===============================================================================
@@ -292,27 +797,28 @@ def addPathInFileList(relPath, isDir, options):
     for i in range(0, len(parts)):
         parentDir = "/".join(parts[0:i])
         if parentDir != "" and parentDir not in options.fileListDirs:
-            options.fileListDirs.append(parentDir)
+            options.fileListDirs.add(parentDir)
             options.fileListFile.write("%s/\n" % parentDir)
 
     if isDir:
-        if relPath not in options.fileListDirs:
-            options.fileListDirs.append(relPath)
+        options.fileListDirs.add(relPath)
         relPath += "/"
     options.fileListFile.write("%s\n" % relPath)
 
 #===============================================================================
 # Copy a file/link.
 #===============================================================================
-def doCopy(dstFileName, srcFileName, options, forceCopy=False):
+def doCopy(dstFileName, srcFileName, options, forceCopy=False, srcIsLink=None):
     relPath = os.path.relpath(dstFileName, options.finalDir)
+    if srcIsLink is None:
+        srcIsLink = os.path.islink(srcFileName)
 
     # do we need to strip ?
     doStrip = False
     if options.strip is not None \
-            and not os.path.islink(srcFileName) \
+            and not srcIsLink \
             and isExec(srcFileName) \
-            and canStrip(srcFileName):
+            and canStrip(srcFileName, options):
         doStrip = True
 
     # Files in usr/lib/debug, usr/lib/.debug or lib/.debug are never to be stripped
@@ -337,9 +843,30 @@ def doCopy(dstFileName, srcFileName, options, forceCopy=False):
 
     # check if we need to do something, do not follow symlinks
     doAction = forceCopy
-    if not os.path.lexists(dstFileName):
+    if options.syncManifest is not None:
+        # compare with what was installed by the previous run
+        manifest = options.syncManifest
+        if not srcIsLink and manifest.hasLink(relPath):
+            logging.warning("Unable to overwrite symlink '%s' with file '%s'",
+                dstFileName, srcFileName)
+            return
+        entry = manifest.makeEntry(srcFileName, srcIsLink, doStrip)
+        manifest.add(relPath, entry)
+        if manifest.isUpToDate(relPath, entry, dstFileName):
+            options.stats.addAction("up-to-date", entry[1])
+            # cancel the copy of a file overwritten by this one
+            copier = options.makefile if options.makefile is not None \
+                    else options.copyEngine
+            copier.rules.pop(dstFileName, None)
+            return
+        # a link installed by the previous run is replaced by a file
+        if not srcIsLink and os.path.islink(dstFileName):
+            os.unlink(dstFileName)
+            invalidateRealPathCache()
+        doAction = True
+    elif not os.path.lexists(dstFileName):
         doAction = True
-    elif not os.path.islink(srcFileName):
+    elif not srcIsLink:
         if os.path.islink(dstFileName):
             logging.warning("Unable to overwrite symlink '%s' with file '%s'",
                 dstFileName, srcFileName)
@@ -352,7 +879,7 @@ def doCopy(dstFileName, srcFileName, options, forceCopy=False):
     # nothing to do if destination is already OK
     if not doAction:
         return
-    if os.path.islink(srcFileName):
+    if srcIsLink:
         logging.info("Link : %s", relPath)
     else:
         logging.info("File : %s", relPath)
@@ -363,63 +890,147 @@ def doCopy(dstFileName, srcFileName, options, forceCopy=False):
         os.makedirs(dstDirName, 0o755)
 
     # do the copy by wanted method (always process links directly)
-    if options.makefile is not None and not os.path.islink(srcFileName):
+    if srcIsLink:
+        if not doCopyDirect(dstFileName, srcFileName, options, doStrip):
+            options.copyFailed = True
+            if options.syncManifest is not None:
+                options.syncManifest.setFailed(relPath)
+    elif options.makefile is not None:
         doCopyByMakefile(dstFileName, srcFileName, options, doStrip)
     else:
-        doCopyDirect(dstFileName, srcFileName, options, doStrip)
+        options.copyEngine.addCopyCmd(dstFileName, srcFileName, doStrip)
 
 #===============================================================================
-# Process a directory and copy dirs/files to final directory.
+# Match names of directories and files to exclude.
+#
+# Patterns without wildcards are looked up in a set, the others are compiled
+# in a single regular expression.
+#===============================================================================
+class ExcludeMatcher(object):
+    def __init__(self, dirPatterns, filePatterns, extensions):
+        (self.dirNames, self.reDirs) = ExcludeMatcher._compile(dirPatterns)
+        (self.fileNames, self.reFiles) = ExcludeMatcher._compile(filePatterns)
+        self.extensions = frozenset(extensions)
+
+    def matchDir(self, name):
+        return name in self.dirNames or \
+                (self.reDirs is not None and self.reDirs.match(name) is not None)
+
+    def matchFile(self, name):
+        return name in self.fileNames or \
+                (self.reFiles is not None and self.reFiles.match(name) is not None)
+
+    def matchExtension(self, name):
+        return os.path.splitext(name)[1] in self.extensions
+
+    @staticmethod
+    def _compile(patterns):
+        names = set()
+        regexes = []
+        for pattern in patterns:
+            if any([c in pattern for c in "*?["]):
+                regexes.append(fnmatch.translate(pattern))
+            else:
+                names.add(pattern)
+        regex = re.compile("|".join(regexes)) if regexes else None
+        return (frozenset(names), regex)
+
+#===============================================================================
+# Walk a directory like os.walk but with the DirEntry of sub-directories and
+# files. Symbolic links to directories are put with files and not followed.
 #===============================================================================
-def processDir(rootDir, options, withEmptyDir, copyType, forceCopy=False):
-    for (dirPath, dirNames, fileNames) in os.walk(rootDir):
-        # a symlink to an existing directory is put in dirNames, not fileNames
-        # fix this (use a copy in for loop because we will modify dirNames)
-        for dirName in dirNames[:]:
-            if os.path.islink(os.path.join(dirPath, dirName)):
-                dirNames.remove(dirName)
-                fileNames.append(dirName)
+def walkDir(rootDir):
+    try:
+        with os.scandir(rootDir) as it:
+            entries = list(it)
+    except OSError:
+        return
+    dirEntries = []
+    fileEntries = []
+    linkEntries = []
+    for entry in entries:
+        try:
+            isDir = entry.is_dir()
+        except OSError:
+            isDir = False
+        if not isDir:
+            fileEntries.append(entry)
+        elif entry.is_symlink():
+            linkEntries.append(entry)
+        else:
+            dirEntries.append(entry)
+    # Caller can remove entries from 'dirEntries' to skip them
+    yield (rootDir, dirEntries, fileEntries + linkEntries)
+    for entry in dirEntries:
+        yield from walkDir(entry.path)
 
+#===============================================================================
+# Process a directory and copy dirs/files to final directory.
+# If 'deferred' is given, files not copied because of 'copyType' are added to
+# it so they can be processed later by processFiles without walking the
+# directory again.
+#===============================================================================
+def processDir(rootDir, options, withEmptyDir, copyType, forceCopy=False,
+        deferred=None):
+    matcher = options.excludeMatcher
+    for (dirPath, dirEntries, fileEntries) in walkDir(rootDir):
         # exclude some directories
-        # (use a copy in for loop because we will modify dirNames)
-        for dirName in dirNames[:]:
-            if any([fnmatch.fnmatch(dirName, pattern)
-                        for pattern in EXCLUDE_DIRS[options.mode]]):
+        # (use a copy in for loop because we will modify dirEntries)
+        for dirEntry in dirEntries[:]:
+            if matcher.matchDir(dirEntry.name):
                 logging.debug("Exclude directory : %s",
-                    os.path.relpath(os.path.join(dirPath, dirName), rootDir))
-                dirNames.remove(dirName)
+                    os.path.relpath(dirEntry.path, rootDir))
+                options.stats.addAction("exclude-dir")
+                dirEntries.remove(dirEntry)
 
         # create directories (useful for empty directories)
         if withEmptyDir:
-            for dirName in dirNames:
-                srcDirName = os.path.join(dirPath, dirName)
-                relPath = os.path.relpath(srcDirName, rootDir)
+            for dirEntry in dirEntries:
+                relPath = os.path.relpath(dirEntry.path, rootDir)
                 dstDirName = getRealPath(options.finalDir, relPath)
                 addPathInFileList(relPath, True, options)
+                if options.syncManifest is not None:
+                    options.syncManifest.addDir(
+                            os.path.relpath(dstDirName, options.finalDir))
                 if not os.path.lexists(dstDirName):
                     logging.info("Directory : %s", relPath)
                     os.makedirs(dstDirName, 0o755)
 
         # copy files
-        for fileName in fileNames:
-            if any([fnmatch.fnmatch(fileName, pattern)
-                        for pattern in EXCLUDE_FILES[options.mode]]):
+        for fileEntry in fileEntries:
+            if matcher.matchFile(fileEntry.name):
                 logging.debug("Exclude file : %s",
-                    os.path.relpath(os.path.join(dirPath, fileName), rootDir))
+                    os.path.relpath(fileEntry.path, rootDir))
+                options.stats.addAction("exclude")
                 continue
             # skip some extensions
-            srcFileName = os.path.join(dirPath, fileName)
+            srcFileName = fileEntry.path
             relPath = os.path.relpath(srcFileName, rootDir)
-            if os.path.splitext(srcFileName)[1] in EXCLUDE_FILTERS[options.mode]:
+            if matcher.matchExtension(fileEntry.name):
                 logging.debug("Exclude file : %s", relPath)
+                options.stats.addAction("exclude")
                 continue
 
             # go
+            isLink = fileEntry.is_symlink()
             if copyType == CopyType.ALL \
-                or (copyType == CopyType.NO_LINKS and not os.path.islink(srcFileName)) \
-                or (copyType == CopyType.ONLY_LINKS and os.path.islink(srcFileName)):
+                or (copyType == CopyType.NO_LINKS and not isLink) \
+                or (copyType == CopyType.ONLY_LINKS and isLink):
                 dstFileName = getRealPath(options.finalDir, relPath)
-                doCopy(dstFileName, srcFileName, options, forceCopy=forceCopy)
+                doCopy(dstFileName, srcFileName, options, forceCopy=forceCopy,
+                        srcIsLink=isLink)
+            elif deferred is not None:
+                deferred.append((srcFileName, relPath, isLink))
+
+#===============================================================================
+# Copy files found by processDir in a previous walk.
+# The destination is resolved now as links may have been created since.
+#===============================================================================
+def processFiles(files, options, forceCopy=False):
+    for (srcFileName, relPath, isLink) in files:
+        dstFileName = getRealPath(options.finalDir, relPath)
+        doCopy(dstFileName, srcFileName, options, forceCopy=forceCopy,
+                srcIsLink=isLink)
 
 #===============================================================================
 # Process linux basic skel.
@@ -435,6 +1046,8 @@ def processLinuxBasicSkel(options):
             dstLnkName = getRealPath(options.finalDir, entry[0])
             logging.info("Link : %s", entry[0])
             os.system("ln -sf \"%s\" \"%s\"" % (entry[1], dstLnkName))
+            options.stats.addProcess()
+            invalidateRealPathCache()
 
 #===============================================================================
 # Main function.
@@ -442,6 +1055,7 @@ def processLinuxBasicSkel(options):
 def main():
     options = parseArgs()
     setupLog(options)
+    options.stats = stats.Stats(options.statsPath)
 
     # get parameters
     options.stagingDir = os.path.realpath(options.stagingDir)
@@ -449,9 +1063,22 @@ def main():
     logging.info("staging-dir : %s", options.stagingDir)
     logging.info("final-dir : %s", options.finalDir)
 
-    # do we need to output a makefile ?
+    # information about elf files and stripped files
+    options.elfCache = elfcache.ElfCache(options.elfCachePath)
+    options.stripCache = None
+    if options.stripCacheDir is not None:
+        options.stripCache = stripcache.StripCache(
+                os.path.realpath(options.stripCacheDir), options.elfCache)
+
+    # copies done directly that failed
+    options.copyFailed = False
+
+    # do we need to output a makefile ? otherwise copy with our own threads
     makefilePath = options.makefile
-    if options.makefile is not None:
+    options.copyEngine = None
+    if options.makefile is None:
+        options.copyEngine = CopyEngine(options.jobs)
+    else:
         logging.info("makefile : %s", makefilePath)
         try:
             options.makefile = Makefile(open(makefilePath, "w"))
@@ -462,13 +1089,23 @@ def main():
     # update filter
     if options.mode != MODE_FULL and not options.keepPythonFiles:
         EXCLUDE_FILTERS[options.mode].extend(EXCLUDE_FILTERS_PYTHON)
+    options.excludeMatcher = ExcludeMatcher(EXCLUDE_DIRS[options.mode],
+            EXCLUDE_FILES[options.mode], EXCLUDE_FILTERS[options.mode])
+
+    # state of the final directory of the previous run
+    options.syncManifest = None
+    if options.manifestPath is not None:
+        options.syncManifest = SyncManifest(options.manifestPath, options)
+        options.stats.addAction("remove-generated",
+                count=options.syncManifest.removeGenerated())
 
     # filelist file
     options.fileListFile = None
-    options.fileListDirs = []
+    options.fileListDirs = set()
     if options.fileListPath is not None:
         try:
-            options.fileListFile = open(options.fileListPath, "w")
+            options.fileListFile = open(options.fileListPath, "w",
+                    buffering=FILELIST_BUFFER_SIZE)
         except IOError as ex:
             logging.error("Failed to create file: %s [err=%d %s]",
                     options.fileListPath, ex.errno, ex.strerror)
@@ -484,25 +1121,63 @@ def main():
     if not os.path.isdir(options.stagingDir):
         logging.error("%s is not a directory", options.stagingDir)
 
+    options.stats.endPhase("setup")
+
     # process links of skeleton directory (with empty dirs and links)
+    # Other files are kept to be processed after staging without walking
+    # the skeleton directory again
+    skelFiles = []
     for skelDir in options.skelDirs:
-        processDir(skelDir, options, True, CopyType.ONLY_LINKS)
+        processDir(skelDir, options, True, CopyType.ONLY_LINKS,
+                deferred=skelFiles)
+    options.stats.endPhase("skeleton links")
 
     # process staging directory (without empty dirs and with all files)
     processDir(options.stagingDir, options, False, CopyType.ALL)
+    options.stats.endPhase("staging")
 
-    # process skeleton directory (without empty dirs and without links)
+    # process files of skeleton directory (without empty dirs and without links)
     # Force copy of file (always overwrite)
-    for skelDir in options.skelDirs:
-        processDir(skelDir, options, False, CopyType.NO_LINKS, forceCopy=True)
+    processFiles(skelFiles, options, forceCopy=True)
+    options.stats.endPhase("skeleton files")
 
     # process linux basic skel
     if options.linuxBasicSkel:
         processLinuxBasicSkel(options)
+        options.stats.endPhase("linux basic skel")
+
+    # remove files not installed anymore
+    if options.syncManifest is not None:
+        options.stats.addAction("remove",
+                count=options.syncManifest.removeStale())
+        options.stats.addAction("remove-generated",
+                count=options.syncManifest.removeOutdatedGenerated())
+        options.stats.endPhase("stale files")
 
     if options.makefile is not None:
         options.makefile.write(options)
         options.makefile.fout.close()
+        options.stats.endPhase("makefile")
+    result = not options.copyFailed
+    if options.copyEngine is not None:
+        result = options.copyEngine.run(options) and result
+        options.stats.endPhase("copy")
+
+    if options.fileListFile is not None:
+        options.fileListFile.close()
+
+    if options.syncManifest is not None:
+        options.syncManifest.save()
+    options.elfCache.save()
+    if options.stripCache is not None:
+        options.stats.addAction("strip-cache-pruned",
+                count=options.stripCache.prune())
+    options.stats.endPhase("save")
+    options.stats.addAction("elf-cache-misses", count=options.elfCache.misses)
+    options.stats.addAction("elf-cache-hits", count=options.elfCache.hits)
+    options.stats.save()
+    if not result:
+        sys.exit(1)
 
 #===============================================================================
 # Setup option parser and parse command line.
@@ -553,11 +1228,63 @@ def parseArgs():
         default=None,
         metavar="FILE",
         help="file where to store list of installed files")
+    parser.add_argument("--link-mode",
+        dest="linkMode",
+        default=LINK_MODE_COPY,
+        choices=LINK_MODES,
+        help="how to install files that are not stripped: hard link or "
+            "reflink them when possible instead of copying them "
+            "(default is %s)" % LINK_MODE_COPY)
+    parser.add_argument("--manifest",
+        dest="manifestPath",
+        default=None,
+        metavar="FILE",
+        help="file where to save the state of the final directory so the "
+            "next run only copies modified files and removes stale ones")
+    parser.add_argument("--generated",
+        dest="generatedPath",
+        default=None,
+        metavar="FILE",
+        help="file listing the files generated in the final directory after "
+            "this script (with the file they are generated from, separated "
+            "by a tab), the previous ones are removed so they are generated "
+            "again (requires --manifest)")
+    parser.add_argument("--removed-py",
+        dest="removedPyDirs",
+        default=[],
+        action="append",
+        metavar="DIR",
+        help="directory where python files are removed after being compiled, "
+            "they are not installed again while they are up to date "
+            "(requires --manifest)")
     parser.add_argument("--keep-python-files",
         dest="keepPythonFiles",
         action="store_true",
         default=False,
         help="keep python files (*.py, *.pyc, *.pyo)")
+    parser.add_argument("--elf-cache",
+        dest="elfCachePath",
+        default=None,
+        metavar="FILE",
+        help="file where to cache information extracted from elf files")
+    parser.add_argument("--strip-cache",
+        dest="stripCacheDir",
+        default=None,
+        metavar="DIR",
+        help="directory where to cache stripped files across runs")
+    parser.add_argument("-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=host.getMakeJobs(),
+        metavar="N",
+        help="number of threads used to copy files when no makefile is "
+            "generated (default: number of jobs of make)")
+    parser.add_argument("--stats",
+        dest="statsPath",
+        default=None,
+        metavar="FILE",
+        help="file where to save statistics (time per phase, files per "
+            "action, slowest strips...) in json format")
     parser.add_argument("--mode",
         dest="mode",
         default=MODE_DEFAULT,
@@ -4,25 +4,26 @@ import sys, os, logging
 import argparse
 import tarfile
 
+import libelf
+import elfcache
+
 #===============================================================================
 # Determine if a file is an executable.
 #===============================================================================
-def isExec(filePath):
-    result = False
+def isExec(elfCache, filePath):
     try:
-        fd = open(filePath, "rb")
-        header = str(fd.read(4))
-        if header.find("ELF") >= 0:
-            result = True
-        fd.close()
+        return elfCache.getInfo(filePath) is not None
+    except libelf.ElfError:
+        # Invalid elf, but still an elf
+        return True
     except IOError as ex:
         logging.error("Failed to open file: %s ([err=%d] %s)",
             filePath, ex.errno, ex.strerror)
-    return result
+    return False
 
 #===============================================================================
 #===============================================================================
-def getFileList(stagingDir):
+def getFileList(stagingDir, elfCache):
     usrSrcValaDir = os.path.join(stagingDir, "usr", "src", "vala")
     result = []
     for (dirPath, dirNames, fileNames) in os.walk(stagingDir):
@@ -32,11 +33,11 @@ def getFileList(stagingDir):
                 targetPath = os.path.realpath(filePath)
                 if targetPath in result:
                     result.append(filePath)
-                elif targetPath.startswith(stagingDir) and isExec(targetPath):
+                elif targetPath.startswith(stagingDir) and isExec(elfCache, targetPath):
                     result.append(filePath)
                     result.append(targetPath)
             elif filePath not in result:
-                if isExec(filePath) or filePath.startswith(usrSrcValaDir):
+                if isExec(elfCache, filePath) or filePath.startswith(usrSrcValaDir):
                     result.append(filePath)
     return result
 
@@ -65,7 +66,9 @@ def main():
     options = parseArgs()
     setupLog(options)
 
-    fileList = getFileList(options.stagingDir)
+    elfCache = elfcache.ElfCache(options.elfCachePath)
+    fileList = getFileList(options.stagingDir, elfCache)
+    elfCache.save()
     createTarFile(options.outTarFile, fileList, options.stagingDir)
 
 #===============================================================================
@@ -80,6 +83,11 @@ def parseArgs():
     parser.add_argument("outTarFile", help="OUtput tar file")
 
     # Other options
+    parser.add_argument("--elf-cache",
+        dest="elfCachePath",
+        default=None,
+        metavar="FILE",
+        help="file where to cache information extracted from elf files")
     parser.add_argument("-q",
         dest="quiet",
         action="store_true",
@@ -5,8 +5,11 @@
 import os, logging
 import stat
 import ctypes
+import bisect
+import json
 import mmap
 import random
+import re
 import time
 import math
 
@@ -43,6 +46,8 @@ EXTFS_NAME_LEN = 255
 
 EXTFS_EXT_MAGIC = 0xf30a
 EXTFS_EXT_ENTRY_SIZE = 12
+EXTFS_EXT_HEADER_SIZE = 12
+EXTFS_EXT_MAX_LEN = 32768                   # Max blocks of an initialized extent
 
 # EXTFS_SUPER_BLOCK::feature_compat
 EXTFS_FEATURE_COMPAT_DIR_PREALLOC = 0x0001
@@ -394,6 +399,7 @@ class ExtfsExtentHeader(ctypes.LittleEndianStructure):
         ("depth", ctypes.c_uint16),         # Has tree real underlying blocks?
         ("generation", ctypes.c_uint32),    # Generation of the tree
     ]
+assert ctypes.sizeof(ExtfsExtentHeader) == EXTFS_EXT_HEADER_SIZE
 
 #===============================================================================
 #===============================================================================
@@ -428,6 +434,101 @@ JFS_SUPERBLOCK_V1 = 3
 JFS_SUPERBLOCK_V2 = 4
 JFS_REVOKE_BLOCK = 5
 
+# Bytes of a bitmap with at least one free bit
+_RE_BITMAP_NOT_FULL = re.compile(b"[^\xff]")
+# Bytes of a bitmap with at least one used bit
+_RE_BITMAP_NOT_EMPTY = re.compile(b"[^\x00]")
+
+# Size of the buffer used to read file data and detect blocks with zeros
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Increment when the content of the image manifest changes
+MANIFEST_VERSION = 1
+
+#===============================================================================
+# Iterate over the runs of set bits of a bitmap, limited to 'nbits' bits.
+# Yields (first, count) tuples.
+#===============================================================================
+def _getBitRuns(data, nbits):
+    val = int.from_bytes(data, "little")
+    pos = 0
+    while val != 0 and pos < nbits:
+        # Skip cleared bits, then count set bits
+        skip = (val & -val).bit_length() - 1
+        val >>= skip
+        pos += skip
+        count = (~val & (val + 1)).bit_length() - 1
+        val >>= count
+        if pos < nbits:
+            yield (pos, min(count, nbits - pos))
+        pos += count
+
+#===============================================================================
+# Manifest of the blocks of a generated image: ranges of used blocks (the
+# other ones are free and their content does not matter) and ranges of used
+# blocks known to only contain zeros (left as holes in the image file).
+# Ranges are lists of [first, count] sorted by block number.
+#===============================================================================
+class ImageManifest(object):
+    def __init__(self, blockSize, blockCount):
+        self.blockSize = blockSize
+        self.blockCount = blockCount
+        self.used = []
+        self.zero = []
+
+    # Add a range, merged with the last one if contiguous
+    @staticmethod
+    def addRange(ranges, first, count):
+        if ranges and ranges[-1][0] + ranges[-1][1] == first:
+            ranges[-1][1] += count
+        else:
+            ranges.append([first, count])
+
+    @staticmethod
+    def _isInRanges(ranges, blockNum):
+        i = bisect.bisect_right(ranges, [blockNum, float("inf")]) - 1
+        return i >= 0 and blockNum < ranges[i][0] + ranges[i][1]
+
+    # Blocks outside the file system (appended to the image after its
+    # generation for example) are considered as used
+    def isBlockUsed(self, blockNum):
+        if blockNum >= self.blockCount:
+            return True
+        return ImageManifest._isInRanges(self.used, blockNum)
+
+    def isBlockZero(self, blockNum):
+        return ImageManifest._isInRanges(self.zero, blockNum)
+
+    def getUsedBlockCount(self):
+        return sum(count for (_, count) in self.used)
+
+    def save(self, filePath):
+        logging.debug("Saving image manifest '%s'", filePath)
+        with open(filePath, "w") as fout:
+            json.dump({
+                "version": MANIFEST_VERSION,
+                "blockSize": self.blockSize,
+                "blockCount": self.blockCount,
+                "used": self.used,
+                "zero": self.zero,
+            }, fout)
+
+    # Raise ValueError if the file is not a valid manifest
+    @staticmethod
+    def load(filePath):
+        with open(filePath, "r") as fin:
+            data = json.load(fin)
+        try:
+            if data["version"] != MANIFEST_VERSION:
+                raise ValueError("Bad image manifest version: %s (%d)" % (
+                        data["version"], MANIFEST_VERSION))
+            manifest = ImageManifest(data["blockSize"], data["blockCount"])
+            manifest.used = data["used"]
+            manifest.zero = data["zero"]
+        except (KeyError, TypeError):
+            raise ValueError("Bad image manifest: %s" % filePath)
+        return manifest
+
 #===============================================================================
 #===============================================================================
 class Extfs(object):
@@ -443,6 +544,8 @@ class Extfs(object):
         self.max_blocks_per_group = blocksize * 8
         self.max_inodes_per_group = blocksize * 8
         self.inoblk = self.blocksize // Extfs.INODE_BLOCKSIZE
+        # Map blocks of inodes with extent trees instead of indirect blocks
+        self.useExtents = (version >= 4)
         logging.debug("blockCount=%d", blockCount)
         logging.debug("inodeCount=%d", inodeCount)
 
@@ -539,6 +642,8 @@ class Extfs(object):
         self.sb.feature_compat = 0
         self.sb.feature_incompat = EXTFS_FEATURE_INCOMPAT_FILETYPE
         self.sb.feature_ro_compat = 0
+        if self.useExtents:
+            self.sb.feature_incompat |= EXTFS_FEATURE_INCOMPAT_EXTENTS
 
         # Need to specify some more info if using 64-bit block group desc
         if self.groupDescStructSize >= EXTFS_GROUP_DESC_V4_STRUCT_SIZE:
@@ -586,6 +691,17 @@ class Extfs(object):
             ibmpos += blocksPerGroup
             itblpos += blocksPerGroup
 
+        # Index of the first bit that may be free in the block/inode bitmap
+        # of each group (bits are never cleared once allocated)
+        self.blockCursors = [0] * groupCount
+        self.inodeCursors = [0] * groupCount
+        # Blocks reserved by reserveBlocks not used yet: [grp, next, end]
+        self.reservedRun = None
+        # Used blocks left with zeros, and buffers to detect them
+        self.zeroBlocks = []
+        self.zeroBlock = bytes(self.blocksize)
+        self.copyBuf = bytearray(max(COPY_BUFFER_SIZE, self.blocksize))
+
         # Mark non-filesystem blocks and inodes as allocated
         # Mark system blocks and inodes as allocated
         for i in range(0, len(self.groups)):
@@ -693,7 +809,19 @@ class Extfs(object):
         return inum - 1 - self.getGroupOfInode(inum) * self.sb.inodes_per_group
 
     def getInodeBlock(self, inum, idx):
+        return self.getBlock(self.getInodeBlockNum(inum, idx))
+
+    # Get the block number of a block of an inode, allocate it (and the
+    # indirect blocks needed) if not yet done
+    def getInodeBlockNum(self, inum, idx):
         inode = self.getInode(inum)
+        if inode.flags & EXTFS_INODE_FLAG_EXTENTS:
+            # Blocks are mapped by extendBlock before being accessed
+            blk = self.getExtentBlock(inode, idx)
+            if blk == 0:
+                raise MemoryError("Unmapped inode block index : %d" % idx)
+            return blk
+
         numPerBlock = self.blocksize // 4
         idxList = []
 
@@ -729,71 +857,377 @@ class Extfs(object):
             if blockNumArray[idxList[i]] == 0:
                 blockNumArray[idxList[i]] = self.allocBlock(inum)
                 inode.blocks += self.inoblk
-            block = self.getBlock(blockNumArray[idxList[i]])
-            blockNumArray = ctypes.cast(block, ctypes.POINTER(ctypes.c_uint32))
-        return block
-
-    # Allocate a block
-    def allocBlock(self, inum):
-        # Try to allocate a block in same group
-        grp = self.getGroupOfInode(inum)
-        if self.groups[grp].free_blocks_count > 0:
-            blk = Extfs.allocate(self.getGroupBBM(grp))
-            assert blk >= 0
+            blk = blockNumArray[idxList[i]]
+            if i < len(idxList) - 1:
+                blockNumArray = ctypes.cast(self.getBlock(blk),
+                        ctypes.POINTER(ctypes.c_uint32))
+        return blk
+
+    # Get the header and entries of an extent tree node at a given address
+    def getExtentNode(self, addr):
+        hdr = _from_address(ExtfsExtentHeader, addr)
+        entryType = ExtfsExtent if hdr.depth == 0 else ExtfsExtentIdx
+        entries = _from_address(entryType * hdr.max, addr + EXTFS_EXT_HEADER_SIZE)
+        return (hdr, entries)
+
+    # Initialize an extent tree node at a given address
+    def initExtentNode(self, addr, maxEntries, depth):
+        hdr = _from_address(ExtfsExtentHeader, addr)
+        hdr.magic = EXTFS_EXT_MAGIC
+        hdr.entries = 0
+        hdr.max = maxEntries
+        hdr.depth = depth
+        hdr.generation = 0
+
+    # Make an empty inode use an extent tree rooted in its block array
+    def initExtentTree(self, inode):
+        inode.flags |= EXTFS_INODE_FLAG_EXTENTS
+        self.initExtentNode(ctypes.addressof(inode.block),
+                (ctypes.sizeof(inode.block) - EXTFS_EXT_HEADER_SIZE) //
+                        EXTFS_EXT_ENTRY_SIZE, 0)
+
+    # Allocate a new node of the extent tree of an inode
+    def allocExtentNode(self, inum, inode, depth):
+        blk = self.allocBlock(inum)
+        inode.blocks += self.inoblk
+        block = self.getBlock(blk)
+        ctypes.memset(block, 0, self.blocksize)
+        self.initExtentNode(ctypes.addressof(block),
+                (self.blocksize - EXTFS_EXT_HEADER_SIZE) // EXTFS_EXT_ENTRY_SIZE,
+                depth)
+        return blk
+
+    # Get the physical block of a logical block of an inode using extents.
+    # Returns 0 if the block is not mapped.
+    def getExtentBlock(self, inode, idx):
+        (hdr, entries) = self.getExtentNode(ctypes.addressof(inode.block))
+        while hdr.depth > 0:
+            # Last index starting before the block (blocks are appended so
+            # search from the end)
+            for i in range(hdr.entries - 1, -1, -1):
+                if entries[i].block <= idx:
+                    break
+            else:
+                return 0
+            leaf = (entries[i].leaf_hi << 32) | entries[i].leaf_lo
+            (hdr, entries) = self.getExtentNode(
+                    ctypes.addressof(self.getBlock(leaf)))
+        for i in range(hdr.entries - 1, -1, -1):
+            ext = entries[i]
+            if ext.block <= idx:
+                if idx >= ext.block + ext.len:
+                    return 0
+                return ((ext.start_hi << 32) | ext.start_lo) + idx - ext.block
+        return 0
+
+    # Map 'count' physical blocks starting at 'blk' to the logical blocks
+    # starting at 'idx' which shall be after the last mapped one.
+    def appendExtent(self, inum, inode, idx, blk, count):
+        while count > 0:
+            # Get the path from the root to the last leaf
+            path = [ctypes.addressof(inode.block)]
+            (hdr, entries) = self.getExtentNode(path[-1])
+            while hdr.depth > 0:
+                last = entries[hdr.entries - 1]
+                leaf = (last.leaf_hi << 32) | last.leaf_lo
+                path.append(ctypes.addressof(self.getBlock(leaf)))
+                (hdr, entries) = self.getExtentNode(path[-1])
+
+            # Merge with last extent if contiguous
+            if hdr.entries > 0:
+                ext = entries[hdr.entries - 1]
+                start = (ext.start_hi << 32) | ext.start_lo
+                if ext.block + ext.len == idx and start + ext.len == blk \
+                        and ext.len < EXTFS_EXT_MAX_LEN:
+                    n = min(count, EXTFS_EXT_MAX_LEN - ext.len)
+                    ext.len += n
+                    idx += n
+                    blk += n
+                    count -= n
+                    continue
+
+            # Leaf is full, grow the tree and retry
+            if hdr.entries == hdr.max:
+                self.growExtentTree(inum, inode, path, idx)
+                continue
+
+            # New extent in the leaf
+            ext = entries[hdr.entries]
+            hdr.entries += 1
+            n = min(count, EXTFS_EXT_MAX_LEN)
+            ext.block = idx
+            ext.len = n
+            ext.start_hi = blk >> 32
+            ext.start_lo = blk & 0xffffffff
+            idx += n
+            blk += n
+            count -= n
+
+    # Add a new branch to the extent tree for logical blocks starting at
+    # 'idx' given the path to the last leaf which is full.
+    def growExtentTree(self, inum, inode, path, idx):
+        # Deepest index node with room for a new entry
+        for level in range(len(path) - 2, -1, -1):
+            (hdr, entries) = self.getExtentNode(path[level])
+            if hdr.entries < hdr.max:
+                break
         else:
+            # Tree is full, move the root in a new block and increase depth
+            (hdr, entries) = self.getExtentNode(path[0])
+            firstIdx = entries[0].block
+            blk = self.allocExtentNode(inum, inode, hdr.depth)
+            block = self.getBlock(blk)
+            (newHdr, newEntries) = self.getExtentNode(ctypes.addressof(block))
+            newHdr.entries = hdr.entries
+            ctypes.memmove(newEntries, entries, hdr.entries * EXTFS_EXT_ENTRY_SIZE)
+            hdr.depth += 1
+            hdr.entries = 1
+            (hdr, entries) = self.getExtentNode(path[0])
+            entries[0].block = firstIdx
+            entries[0].leaf_lo = blk & 0xffffffff
+            entries[0].leaf_hi = blk >> 32
+            entries[0].unused = 0
+            return
+
+        # Chain of new nodes down to a new empty leaf
+        while hdr.depth > 0:
+            blk = self.allocExtentNode(inum, inode, hdr.depth - 1)
+            entry = entries[hdr.entries]
+            hdr.entries += 1
+            entry.block = idx
+            entry.leaf_lo = blk & 0xffffffff
+            entry.leaf_hi = blk >> 32
+            entry.unused = 0
+            (hdr, entries) = self.getExtentNode(
+                    ctypes.addressof(self.getBlock(blk)))
+
+    # Find the first free bit of a bitmap block starting at bit 'start'.
+    # Returns -1 if there is none.
+    def findFreeBit(self, bitmapBlk, start):
+        off = bitmapBlk * self.blocksize
+        pos = off + start // 8
+        # Bits before start in the first byte are considered as used
+        bits = self.buf[pos] | ((1 << (start % 8)) - 1)
+        if bits == 0xff:
+            match = _RE_BITMAP_NOT_FULL.search(self.buf, pos + 1,
+                    off + self.blocksize)
+            if match is None:
+                return -1
+            pos = match.start()
+            bits = self.buf[pos]
+        # Index of lowest cleared bit
+        return (pos - off) * 8 + (~bits & (bits + 1)).bit_length() - 1
+
+    # Mark as used at most 'count' contiguous free bits of a bitmap block
+    # starting at free bit 'first'. Returns the number of marked bits.
+    def markBits(self, bitmapBlk, first, count):
+        off = bitmapBlk * self.blocksize
+        end = min(first + count, self.blocksize * 8)
+        bit = first
+        # Bits up to the first whole byte
+        while bit < end and (bit % 8 != 0 or end - bit < 8):
+            mask = 1 << (bit % 8)
+            if self.buf[off + bit // 8] & mask:
+                return bit - first
+            self.buf[off + bit // 8] |= mask
+            bit += 1
+        # Whole free bytes
+        if bit < end:
+            match = _RE_BITMAP_NOT_EMPTY.search(self.buf, off + bit // 8,
+                    off + end // 8)
+            stop = (match.start() - off) * 8 if match is not None \
+                    else end - end % 8
+            self.buf[off + bit // 8:off + stop // 8] = \
+                    b"\xff" * ((stop - bit) // 8)
+            bit = stop
+        # Remaining bits
+        while bit < end:
+            mask = 1 << (bit % 8)
+            if self.buf[off + bit // 8] & mask:
+                break
+            self.buf[off + bit // 8] |= mask
+            bit += 1
+        return bit - first
+
+    # Allocate at most 'count' contiguous blocks, in the group of the inode
+    # if possible. Returns the first block number and the number of blocks.
+    def allocBlocks(self, inum, count):
+        # Try to allocate blocks in same group
+        grp = self.getGroupOfInode(inum)
+        if self.groups[grp].free_blocks_count == 0:
             # Search a group with free block
             for grp in range(0, len(self.groups)):
                 if self.groups[grp].free_blocks_count > 0:
-                    blk = Extfs.allocate(self.getGroupBBM(grp))
-                    assert blk >= 0
                     break
             else:
                 raise MemoryError("Failed to allocate block for inode : %d" % inum)
-        # Update stats and return block number
-        self.groups[grp].free_blocks_count -= 1
-        self.sb.free_blocks_count -= 1
-        return self.sb.first_data_block + grp * self.sb.blocks_per_group + blk
+        group = self.groups[grp]
+        blk = self.findFreeBit(group.block_bitmap, self.blockCursors[grp])
+        assert blk >= 0
+        count = self.markBits(group.block_bitmap, blk,
+                min(count, group.free_blocks_count))
+        self.blockCursors[grp] = blk + count
+        # Update stats and return block numbers
+        group.free_blocks_count -= count
+        self.sb.free_blocks_count -= count
+        return (self.sb.first_data_block + grp * self.sb.blocks_per_group + blk,
+                count)
+
+    # Allocate a block
+    def allocBlock(self, inum):
+        # Use blocks reserved for the inode first
+        run = self.reservedRun
+        if run is not None and run[1] < run[2]:
+            run[1] += 1
+            return run[1] - 1
+        return self.allocBlocks(inum, 1)[0]
+
+    # Reserve contiguous blocks for the next allocations of an inode that
+    # needs 'count' blocks. The blocks not used are released by
+    # releaseBlocks.
+    def reserveBlocks(self, inum, count):
+        assert self.reservedRun is None
+        (blk, count) = self.allocBlocks(inum, count)
+        grp = (blk - self.sb.first_data_block) // self.sb.blocks_per_group
+        self.reservedRun = [grp, blk, blk + count]
+
+    def releaseBlocks(self):
+        (grp, nextBlk, endBlk) = self.reservedRun
+        self.reservedRun = None
+        if nextBlk == endBlk:
+            return
+        group = self.groups[grp]
+        base = self.sb.first_data_block + grp * self.sb.blocks_per_group
+        off = group.block_bitmap * self.blocksize
+        for bit in range(nextBlk - base, endBlk - base):
+            self.buf[off + bit // 8] &= ~(1 << (bit % 8)) & 0xff
+        self.blockCursors[grp] = min(self.blockCursors[grp], nextBlk - base)
+        group.free_blocks_count += endBlk - nextBlk
+        self.sb.free_blocks_count += endBlk - nextBlk
 
     def allocNode(self):
         # Search a group with free inode
         for grp in range(0, len(self.groups)):
             if self.groups[grp].free_inodes_count > 0:
-                inum = Extfs.allocate(self.getGroupIBM(grp))
+                ibm = self.groups[grp].inode_bitmap
+                inum = self.findFreeBit(ibm, self.inodeCursors[grp])
                 assert inum >= 0
+                self.markBits(ibm, inum, 1)
+                self.inodeCursors[grp] = inum + 1
                 self.groups[grp].free_inodes_count -= 1
                 self.sb.free_inodes_count -= 1
                 return grp * self.sb.inodes_per_group + inum + 1
         raise MemoryError("Failed to allocate inode")
 
+    # Copy 'length' bytes of data at offset 'off' of the image. 'src' is
+    # either a bytes-like object (read from 'srcOff') or a binary file object
+    # (read from its current position).
+    # Blocks of a file only containing zeros are not written so they stay
+    # as holes in the image file.
+    def copyData(self, off, src, srcOff, length):
+        if not isinstance(src, (bytes, bytearray, memoryview)) \
+                and off % self.blocksize != 0:
+            name = src.name
+            src = src.read(length)
+            srcOff = 0
+            if len(src) < length:
+                raise IOError("File shrunk while being copied: %s" % name)
+        if isinstance(src, (bytes, bytearray, memoryview)):
+            self.buf[off:off + length] = memoryview(src)[srcOff:srcOff + length]
+            return
+        with memoryview(self.copyBuf) as view:
+            pos = 0
+            while pos < length:
+                # Fill the buffer
+                size = 0
+                bufLen = min(length - pos, len(self.copyBuf))
+                while size < bufLen:
+                    with view[size:bufLen] as chunk:
+                        n = src.readinto(chunk)
+                    if not n:
+                        break
+                    size += n
+                if size < bufLen:
+                    raise IOError("File shrunk while being copied: %s" %
+                            src.name)
+                # Copy runs of blocks that are not all zeros, only check
+                # each block if there is a block of zeros somewhere
+                start = 0
+                if self.copyBuf.find(self.zeroBlock, 0, size) >= 0:
+                    for i in range(0, size - self.blocksize + 1, self.blocksize):
+                        if self.copyBuf.startswith(self.zeroBlock, i):
+                            if start < i:
+                                self.buf[off + pos + start:off + pos + i] = view[start:i]
+                            ImageManifest.addRange(self.zeroBlocks,
+                                    (off + pos + i) // self.blocksize, 1)
+                            start = i + self.blocksize
+                if start < size:
+                    self.buf[off + pos + start:off + pos + size] = view[start:size]
+                pos += size
+
+    # Append 'amount' bytes of 'data' to an inode. 'data' is either a
+    # bytes-like object or a binary file object opened at the start of the
+    # data. Data is copied in the image by runs of contiguous blocks.
+    # With 'nocopy', the data is known to be zeros and 'data' is not used,
+    # new blocks are left as holes in the image file.
     def extendBlock(self, inum, data, amount, nocopy=False):
         inode = self.getInode(inum)
+        if self.useExtents and inode.size == 0 and inode.blocks == 0:
+            self.initExtentTree(inode)
         src = data
         srcOff = 0
         srcLen = amount
 
         # Is there room in last block of inode ?
         if inode.size % self.blocksize != 0:
-            dst = self.getInodeBlock(inum, inode.size // self.blocksize)
+            blk = self.getInodeBlockNum(inum, inode.size // self.blocksize)
             dstOff = inode.size % self.blocksize
             dstLen = self.blocksize - inode.size % self.blocksize
             cpyLen = min(srcLen, dstLen)
             if not nocopy:
-                ctypes.memmove(
-                        _from_address(ctypes.c_void_p, ctypes.addressof(dst) + dstOff),
-                        (ctypes.c_uint8 * cpyLen).from_buffer_copy(src, srcOff),
-                        cpyLen)
+                self.copyData(blk * self.blocksize + dstOff, src, srcOff, cpyLen)
             inode.size += cpyLen
             srcOff += cpyLen
             srcLen -= cpyLen
 
-        # Continue with aligned block copy
-        while srcLen > 0:
-            dst = self.getInodeBlock(inum, inode.size // self.blocksize)
-            cpyLen = min(srcLen, self.blocksize)
-            if not nocopy:
-                ctypes.memmove(dst,
-                        (ctypes.c_uint8 * cpyLen).from_buffer_copy(src, srcOff),
-                        cpyLen)
+        # Continue with aligned blocks, map them all first and remember the
+        # runs of contiguous blocks
+        # With extents, map all the needed blocks with as few extents as
+        # possible.
+        # Otherwise reserve data blocks and some indirect blocks in a single
+        # run, they are allocated in the same order block by block anyway
+        runs = []
+        mapped = (inode.size + self.blocksize - 1) // self.blocksize
+        needed = (inode.size + srcLen + self.blocksize - 1) // self.blocksize
+        if inode.flags & EXTFS_INODE_FLAG_EXTENTS:
+            while mapped < needed:
+                (blk, count) = self.allocBlocks(inum, needed - mapped)
+                inode.blocks += count * self.inoblk
+                self.appendExtent(inum, inode, mapped, blk, count)
+                runs.append([blk, count])
+                mapped += count
+        else:
+            if srcLen > self.blocksize:
+                count = needed - mapped
+                self.reserveBlocks(inum, count + count // (self.blocksize // 4) + 3)
+            try:
+                for idx in range(mapped, needed):
+                    blk = self.getInodeBlockNum(inum, idx)
+                    if runs and runs[-1][0] + runs[-1][1] == blk:
+                        runs[-1][1] += 1
+                    else:
+                        runs.append([blk, 1])
+            finally:
+                if self.reservedRun is not None:
+                    self.releaseBlocks()
+
+        # Copy data
+        for (blk, count) in runs:
+            cpyLen = min(srcLen, count * self.blocksize)
+            if nocopy:
+                ImageManifest.addRange(self.zeroBlocks, blk, count)
+            else:
+                self.copyData(blk * self.blocksize, src, srcOff, cpyLen)
             inode.size += cpyLen
             srcOff += cpyLen
             srcLen -= cpyLen
@@ -882,7 +1316,10 @@ class Extfs(object):
     def addFileNode(self, parent_inum, entry):
         inum = self.addNode(parent_inum, entry)
         if entry.st.st_size > 0:
-            self.extendBlock(inum, entry.getData(), entry.st.st_size)
+            # Copy data directly from the file to the image (errors are
+            # fatal, the image would contain a file without its data)
+            with open(entry.filePath, "rb") as fin:
+                self.extendBlock(inum, fin, entry.st.st_size)
         return inum
 
     def addSymlinkNode(self, parent_inum, entry):
@@ -938,16 +1375,30 @@ class Extfs(object):
         for i in range(0, 16):
             jsb.uuid[i] = self.sb.uuid[i]
 
-        # Write journal super block and pad with empty data
+        # Write journal super block and pad with empty data (not written,
+        # the image is created empty)
         self.extendBlock(inum, content, self.blocksize)
-        empty = bytearray(self.blocksize)
-        for _ in range(1, jsb.maxlen):
-            self.extendBlock(inum, empty, self.blocksize)
+        self.extendBlock(inum, None, (jsb.maxlen - 1) * self.blocksize,
+                nocopy=True)
 
         # Update fd super block
         self.sb.feature_compat |= EXTFS_FEATURE_COMPAT_HAS_JOURNAL
         self.sb.journal_inum = EXTFS_JOURNAL_INO
 
+    # Get the manifest of used blocks of the image
+    def getManifest(self):
+        manifest = ImageManifest(self.blocksize, self.sb.blocks_count)
+        if self.sb.first_data_block > 0:
+            ImageManifest.addRange(manifest.used, 0, self.sb.first_data_block)
+        for grp in range(0, len(self.groups)):
+            base = self.sb.first_data_block + grp * self.sb.blocks_per_group
+            nbits = min(self.sb.blocks_per_group, self.sb.blocks_count - base)
+            for (first, count) in _getBitRuns(self.getGroupBBM(grp), nbits):
+                ImageManifest.addRange(manifest.used, base + first, count)
+        for (first, count) in sorted(self.zeroBlocks):
+            ImageManifest.addRange(manifest.zero, first, count)
+        return manifest
+
     def populate(self, parent_inum, tree):
         for child in tree.children.values():
             if stat.S_IFMT(child.st.st_mode) == stat.S_IFDIR:
@@ -959,14 +1410,21 @@ class Extfs(object):
                 self.addSymlinkNode(parent_inum, child)
 
 #===============================================================================
+# Generate the image, returns the ImageManifest of the generated image.
+# If 'buf' is given, the image is generated in it instead of the image file
+# and it is left open for the caller.
 #===============================================================================
-def genImage(image, root, version=2, blocksize=1024):
+def genImage(image, root, version=2, blocksize=1024, buf=None):
 
     if blocksize < 1024 or (blocksize & (blocksize - 1)) != 0:
         raise ValueError("Bad value of blocksize: %d" % blocksize)
 
-    os.ftruncate(image.fout.fileno(), image.size)
-    buf = mmap.mmap(image.fout.fileno(), image.size)
+    if buf is not None:
+        ownBuf = False
+    else:
+        os.ftruncate(image.fout.fileno(), image.size)
+        buf = mmap.mmap(image.fout.fileno(), image.size)
+        ownBuf = True
     blockCount = image.size // blocksize
 
     # add a factor to inode_ratio according to an configuration example
@@ -977,8 +1435,12 @@ def genImage(image, root, version=2, blocksize=1024):
     fs = Extfs(buf, blocksize, blockCount, inodeCount, reservedBlockCount, version)
     fs.populate(EXTFS_ROOT_INO, root)
     fs.finalize()
+    manifest = fs.getManifest()
+    if not ownBuf:
+        return manifest
     try:
         buf.close()
     except BufferError:
         # FIXME: 'cannot close exported pointers exist' with python3
         pass
+    return manifest
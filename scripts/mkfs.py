@@ -3,11 +3,13 @@
 import sys, os, logging
 import argparse
 import fnmatch
+import mmap
 import re
 import stat
 import tempfile
 
 import mktar, mkextfs, mkextfs_fast, mkcpio, mkubi
+import sparse
 
 # List of supported file systems
 FS_LIST = [
@@ -195,6 +197,12 @@ def main():
     options = parseArgs()
     setupLog(options)
 
+    if options.sparse and (options.fstype not in ["ext2", "ext3", "ext4"]
+            or options.fast):
+        logging.error("Sparse image only supported for ext2/ext3/ext4 " +
+                "without --fast")
+        sys.exit(1)
+
     # Determine image size
     if options.imageSize.endswith("K"):
         imageSize = int(options.imageSize[:-1]) * 1024
@@ -232,14 +240,36 @@ def main():
         elif options.fstype in ["ext2", "ext3", "ext4"]:
             version = int(options.fstype[3])
             if options.fast:
+                if options.manifestFile:
+                    logging.warning("Image manifest not supported with --fast")
                 # Re-create a root fs with contents and mode/owner set (requires fakeroot)
                 with tempfile.TemporaryDirectory() as tmpRoot:
                     processRoot(tmpRoot)
                     copyTree(tmpRoot, root)
                     mkextfs_fast.genImage(image, tmpRoot, options,
                             version, int(options.blockSize))
+            elif options.sparse:
+                # Generate the raw image in an unlinked sparse temporary
+                # file next to the output (mapped so pages can be written
+                # back instead of filling memory), only its used blocks are
+                # written in the sparse image file
+                imageDir = os.path.dirname(os.path.abspath(options.imageFile))
+                with tempfile.TemporaryFile(dir=imageDir) as rawFile:
+                    rawFile.truncate(imageSize)
+                    buf = mmap.mmap(rawFile.fileno(), imageSize)
+                    manifest = mkextfs.genImage(image, root, version,
+                            int(options.blockSize), buf)
+                    sparse.raw2Sparse(buf, fout, manifest.blockSize, manifest)
+                    try:
+                        buf.close()
+                    except BufferError:
+                        # Same as mkextfs.genImage, pointers may remain
+                        pass
             else:
-                mkextfs.genImage(image, root, version, int(options.blockSize))
+                manifest = mkextfs.genImage(image, root, version,
+                        int(options.blockSize))
+            if not options.fast and options.manifestFile:
+                manifest.save(options.manifestFile)
         elif options.fstype == "ubi":
             # Re-create a root fs with contents and mode/owner set (requires fakeroot)
             with tempfile.TemporaryDirectory() as tmpRoot:
@@ -297,6 +327,20 @@ def parseArgs():
         default=False,
         help="use mke2fs to create an ext2/ext3/ext4 filesystem")
 
+    parser.add_argument("--sparse",
+        dest="sparse",
+        action="store_true",
+        default=False,
+        help="generate an android sparse image of an ext2/ext3/ext4 "
+                "file system (not supported with --fast)")
+
+    parser.add_argument("--manifest",
+        dest="manifestFile",
+        default=None,
+        metavar="FILE",
+        help="save the used blocks of an ext2/ext3/ext4 image in a file "
+                "to be given to sparse.py (not supported with --fast)")
+
     # mke2fs specific options
     parser.add_argument("--mke2fs",
         dest="mke2fs",
@@ -8,6 +8,7 @@ from io import BytesIO
 from mkextfs import ExtfsSuperBlock, EXTFS_SUPER_BLOCK_STRUCT_SIZE
 from mkextfs import ExtfsGroupDescV2, EXTFS_GROUP_DESC_V2_STRUCT_SIZE
 from mkextfs import EXTFS_SUPER_MAGIC
+from mkextfs import ImageManifest
 
 SPARSE_HEADER_MAGIC = 0xed26ff3a
 SPARSE_MAJOR_VERSION = 1
@@ -84,6 +85,10 @@ class Extfs(object):
         bbm = self.bbmList[grp]
         return (bbm[idx // 8] & 1 << (idx % 8)) != 0
 
+    # Content of blocks is not known without reading them
+    def isBlockZero(self, blockNum):
+        return False
+
     @staticmethod
     def load(fin):
         # Read super block at offset 1024
@@ -319,12 +324,15 @@ class SparseFile(object):
         self.header.total_blks = fileSize // self.header.blk_sz
         self.header.total_chunks = len(self.chunks)
 
+    # 'extfs' gives the blocks that are used ('isBlockUsed') and the used
+    # blocks known to be zeros ('isBlockZero'), those blocks are not read.
     def readRawImage(self, fin, blockSize, extfs):
         curChunkType = None
         curVal = 0
         curOff = 0
         curLen = 0
         blockNum = 0
+        offset = 0
 
         # Determine file size
         fin.seek(0, os.SEEK_END)
@@ -335,36 +343,40 @@ class SparseFile(object):
 
         # Process input file
         self.header.blk_sz = blockSize
-        while fin.tell() < fileSize:
-            # Read block
-            buf = fin.read(blockSize)
+        while offset < fileSize:
+            length = min(blockSize, fileSize - offset)
 
             # Determine kind for this block
             chunkType = CHUNK_TYPE_RAW
             if extfs is not None and not extfs.isBlockUsed(blockNum):
                 chunkType = CHUNK_TYPE_SKIP
-            elif len(buf) == blockSize:
+            elif extfs is not None and extfs.isBlockZero(blockNum) \
+                    and length == blockSize:
+                if curChunkType != CHUNK_TYPE_FILL:
+                    curVal = 0
+                if curVal == 0:
+                    chunkType = CHUNK_TYPE_FILL
+            elif length == blockSize:
+                fin.seek(offset, os.SEEK_SET)
+                buf = fin.read(blockSize)
                 # determine value to check for filling
                 if curChunkType != CHUNK_TYPE_FILL:
                     curVal = struct.unpack("<I", buf[0:4])[0]
-                for i in range(0, blockSize, 4):
-                    val = struct.unpack("<I", buf[i:i+4])[0]
-                    if val != curVal:
-                        break
-                else:
+                if buf == struct.pack("<I", curVal) * (blockSize // 4):
                     chunkType = CHUNK_TYPE_FILL
 
             # Append to current chunk if same kind
             if chunkType == curChunkType:
-                curLen += len(buf)
+                curLen += length
             else:
                 # Finish current chunk, start a new one
                 if curChunkType is not None:
                     self._addChunk(curChunkType, curVal, curOff, curLen)
                 curOff += curLen
-                curLen = len(buf)
+                curLen = length
                 curChunkType = chunkType
 
+            offset += length
             blockNum += 1
 
         # Finish last chunk and header
@@ -398,6 +410,7 @@ class SparseFile(object):
                         for i in range(0, len(self.chunks))])
 
 #===============================================================================
+# 'fin' can also be a mmap of the raw image.
 #===============================================================================
 def raw2Sparse(fin, fout, blockSize, extfs):
     sparseFile = SparseFile()
@@ -438,8 +451,17 @@ def main():
 
     try:
         if options.doSparse:
-            # Is it a extfs image ?
-            extfs = Extfs.load(fin)
+            # Use the manifest of the image if any, otherwise is it a
+            # extfs image ?
+            if options.manifestFile:
+                try:
+                    extfs = ImageManifest.load(options.manifestFile)
+                except IOError as ex:
+                    logging.error("Failed to open file: %s [err=%d %s]",
+                            options.manifestFile, ex.errno, ex.strerror)
+                    sys.exit(1)
+            else:
+                extfs = Extfs.load(fin)
             if extfs is not None:
                 options.blockSize = extfs.blockSize
             raw2Sparse(fin, fout, options.blockSize, extfs)
@@ -473,6 +495,12 @@ def parseArgs():
         default=True,
         help="create a raw image from a sparse image")
 
+    parser.add_argument("--manifest",
+        dest="manifestFile",
+        default=None,
+        metavar="FILE",
+        help="manifest of used blocks of the raw image generated by mkfs.py")
+
     parser.add_argument("--size",
         type=int,
         dest="blockSize",
@@ -0,0 +1,84 @@
+#===============================================================================
+# Statistics about the processing done by a script, optionally saved in a
+# json file: wall time per phase, number of files/bytes per action, slowest
+# operations and number of external processes spawned.
+#
+# Counters are protected by a lock so they can be updated by a pool of threads.
+#===============================================================================
+
+import logging
+import heapq
+import json
+import threading
+import time
+
+# Number of slowest operations kept for each kind of operation
+SLOWEST_COUNT = 10
+
+#===============================================================================
+#===============================================================================
+class Stats(object):
+    def __init__(self, filePath=None):
+        self.filePath = filePath
+        self.lock = threading.Lock()
+        self.startTime = time.monotonic()
+        self.phaseStartTime = self.startTime
+        self.phases = []
+        self.actions = {}
+        self.processes = 0
+        self.slowest = {}
+
+    # Record the time spent since the end of the previous phase.
+    def endPhase(self, name):
+        now = time.monotonic()
+        logging.info("Phase '%s' done in %.3fs", name, now - self.phaseStartTime)
+        with self.lock:
+            self.phases.append({"name": name, "time": now - self.phaseStartTime})
+        self.phaseStartTime = now
+
+    # Record files processed by an action ('copy', 'strip'...).
+    def addAction(self, name, size=0, count=1):
+        with self.lock:
+            action = self.actions.setdefault(name, {"files": 0, "bytes": 0})
+            action["files"] += count
+            action["bytes"] += size
+
+    # Record external processes spawned.
+    def addProcess(self, count=1):
+        with self.lock:
+            self.processes += count
+
+    # Record the duration of an operation on a file, only the slowest ones
+    # of each kind of operation are kept.
+    def addOperation(self, name, path, duration):
+        with self.lock:
+            heap = self.slowest.setdefault(name, [])
+            if len(heap) < SLOWEST_COUNT:
+                heapq.heappush(heap, (duration, path))
+            elif duration > heap[0][0]:
+                heapq.heapreplace(heap, (duration, path))
+
+    def toDict(self):
+        with self.lock:
+            return {
+                "time": time.monotonic() - self.startTime,
+                "phases": list(self.phases),
+                "actions": dict(self.actions),
+                "processes": self.processes,
+                "slowest": {
+                    name: [{"path": path, "time": duration}
+                            for (duration, path) in sorted(heap, reverse=True)]
+                    for (name, heap) in self.slowest.items()
+                },
+            }
+
+    def save(self):
+        if self.filePath is None:
+            return
+        logging.debug("Saving stats '%s'", self.filePath)
+        try:
+            with open(self.filePath, "w") as fout:
+                json.dump(self.toDict(), fout, indent=4, sort_keys=True)
+        except IOError as ex:
+            logging.warning("Failed to save stats: %s [err=%d %s]",
+                    self.filePath, ex.errno, ex.strerror)
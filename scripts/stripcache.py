@@ -0,0 +1,129 @@
+#===============================================================================
+# Cache of stripped files.
+#
+# Stripped files are stored in a directory and named after the content of the
+# source file and the strip command. A file is then only stripped once across
+# runs. Files are copied (or reflinked) from the cache, never hard linked, so
+# the mode and timestamps of installed files can be changed.
+#
+# Files of the cache not used for some time are removed by prune.
+#===============================================================================
+
+import os, logging
+import fcntl
+import hashlib
+import itertools
+import shlex
+import shutil
+import subprocess
+import time
+
+# Files not used for this time (in seconds) are removed from the cache
+MAX_AGE = 7 * 24 * 3600
+
+# ioctl to share the data of a file (linux/fs.h)
+FICLONE = 0x40049409
+
+#===============================================================================
+#===============================================================================
+class StripCache(object):
+    def __init__(self, cacheDir, elfCache):
+        self.cacheDir = cacheDir
+        self.elfCache = elfCache
+        # Thread safe counter for temporary files
+        self.tmpCounter = itertools.count(1)
+
+    # Get the path of the stripped file in the cache (it may not exist yet).
+    def getPath(self, srcFilePath, stripCmd):
+        keyHash = hashlib.sha1()
+        keyHash.update(self.elfCache.getFileHash(srcFilePath).encode("UTF-8"))
+        keyHash.update(b"\0" + stripCmd.encode("UTF-8"))
+        key = keyHash.hexdigest()
+        return os.path.join(self.cacheDir, key[0:2], key)
+
+    # Check if a stripped file is in the cache, and mark it as used so it is
+    # not pruned.
+    def isCached(self, cachedFilePath):
+        try:
+            os.utime(cachedFilePath)
+            return True
+        except OSError:
+            return False
+
+    # Get a unique temporary path where to strip a file before renaming it
+    # to its path in the cache.
+    def getTmpPath(self, cachedFilePath):
+        return "%s.%d.%d.tmp" % (cachedFilePath, os.getpid(),
+                next(self.tmpCounter))
+
+    # Strip a file in the cache if not already done.
+    # Returns the path of the stripped file or None on failure.
+    # 'stats' is an optional stats.Stats updated with the strip operations.
+    def strip(self, srcFilePath, stripCmd, stats=None):
+        cachedFilePath = self.getPath(srcFilePath, stripCmd)
+        if self.isCached(cachedFilePath):
+            logging.debug("Strip (cached): '%s'", srcFilePath)
+            if stats is not None:
+                stats.addAction("strip-cached", os.path.getsize(srcFilePath))
+            return cachedFilePath
+
+        logging.debug("Strip: '%s'", srcFilePath)
+        os.makedirs(os.path.dirname(cachedFilePath), exist_ok=True)
+        tmpFilePath = self.getTmpPath(cachedFilePath)
+        # stripCmd may already contains some arguments
+        cmd = shlex.split(stripCmd) + ["-o", tmpFilePath, srcFilePath]
+        try:
+            startTime = time.monotonic()
+            try:
+                subprocess.check_call(cmd)
+            finally:
+                # counted even if it failed
+                if stats is not None:
+                    stats.addProcess()
+            if stats is not None:
+                stats.addOperation("strip", srcFilePath,
+                        time.monotonic() - startTime)
+                stats.addAction("strip", os.path.getsize(srcFilePath))
+            os.rename(tmpFilePath, cachedFilePath)
+            return cachedFilePath
+        except (OSError, subprocess.CalledProcessError) as ex:
+            logging.error("Failed to strip '%s': %s", srcFilePath, ex)
+            if os.path.exists(tmpFilePath):
+                os.unlink(tmpFilePath)
+            return None
+
+    # Remove files not used for 'maxAge' seconds (and temporary files left
+    # by interrupted runs). Returns the number of removed files.
+    def prune(self, maxAge=MAX_AGE):
+        count = 0
+        limit = time.time() - maxAge
+        try:
+            subDirs = [entry.path for entry in os.scandir(self.cacheDir)
+                    if entry.is_dir(follow_symlinks=False)]
+        except OSError:
+            return 0
+        for subDir in subDirs:
+            for entry in os.scandir(subDir):
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime < limit:
+                        os.unlink(entry.path)
+                        count += 1
+                except OSError:
+                    # Removed by someone else in the meantime
+                    pass
+        logging.debug("Pruned %d files from strip cache '%s'", count,
+                self.cacheDir)
+        return count
+
+#===============================================================================
+# Copy a file from the cache, sharing its data if the file system supports it.
+# The destination is removed first as it can be a link to another file.
+#===============================================================================
+def copyFromCache(srcFilePath, dstFilePath):
+    if os.path.lexists(dstFilePath):
+        os.unlink(dstFilePath)
+    with open(srcFilePath, "rb") as fin, open(dstFilePath, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        except OSError:
+            shutil.copyfileobj(fin, fout)
@@ -16,7 +16,8 @@ endif
 .PHONY: __symbols-tar-internal
 __symbols-tar-internal: symbols-clean
 	@echo "Symbols: start"
-	$(Q) $(MAKESYMBOLS_SCRIPT) $(TARGET_OUT_STAGING) $(SYMBOLS_FILE)
+	$(Q) $(MAKESYMBOLS_SCRIPT) $(TARGET_OUT_STAGING) $(SYMBOLS_FILE) \
+		--elf-cache=$(ELF_CACHE_FILE)
 
 # Tar archive, no compression
 .PHONY: symbols-tar
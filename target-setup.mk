@@ -344,6 +344,12 @@ TARGET_IMAGE_FAST ?=
 # firmware: filtered according to internal heuristics suitable for embedded execution
 TARGET_FINAL_MODE ?= firmware
 
+# How files that are not stripped are put in final tree
+# copy: always copy them
+# hardlink: hard link files of staging if on the same file system, copy otherwise
+# reflink: share their data if supported by the file system, copy otherwise
+TARGET_FINAL_LINK_MODE ?= copy
+
 # List of directories to add in ldconfig cache
 TARGET_LDCONFIG_DIRS ?=
 
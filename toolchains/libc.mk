@@ -177,7 +177,7 @@ _libc_copy_files = \
 	$(if $1, \
 		@mkdir -p $(TARGET_OUT_STAGING)/$2$(endl) \
 		$(foreach __f,$1, \
-			$(Q) cp -af $(__f) $(TARGET_OUT_STAGING)/$2/$(notdir $(__f))$(endl) \
+			$(Q) cp -af --remove-destination $(__f) $(TARGET_OUT_STAGING)/$2/$(notdir $(__f))$(endl) \
 		) \
 	)
 
@@ -206,7 +206,7 @@ $(_libc_installed_file): $(BUILD_SYSTEM)/toolchains/libc.mk
 	)
 	$(if $(_libc_ldd), \
 		@mkdir -p $(TARGET_OUT_STAGING)/usr/bin$(endl) \
-		$(Q) cp -af $(_libc_ldd) $(TARGET_OUT_STAGING)/usr/bin$(endl) \
+		$(Q) cp -af --remove-destination $(_libc_ldd) $(TARGET_OUT_STAGING)/usr/bin$(endl) \
 		$(Q) sed -i.bak -e 's|^\#! */bin/bash$$|\#!/bin/sh|' $(TARGET_OUT_STAGING)/usr/bin/ldd$(endl) \
 		@rm -f $(TARGET_OUT_STAGING)/usr/bin/ldd.bak$(endl) \
 	)
@@ -222,7 +222,7 @@ endif
 ifneq ("$(TARGET_INCLUDE_GDBSERVER)","0")
 ifneq ("$(TOOLCHAIN_GDBSERVER)","")
 	@mkdir -p $(TARGET_OUT_STAGING)/usr/bin
-	$(Q) cp -af $(TOOLCHAIN_GDBSERVER) $(TARGET_OUT_STAGING)/usr/bin/gdbserver
+	$(Q) cp -af --remove-destination $(TOOLCHAIN_GDBSERVER) $(TARGET_OUT_STAGING)/usr/bin/gdbserver
 endif
 endif
 	@touch $@